@@ -0,0 +1,272 @@
+"""Warbler's JSON API, version 1.
+
+Everything is under /api/v1 and needs a logged-in session, like the HTML
+pages. Lists come a page at a time:
+
+    {"data": [...], "next": "<cursor>"}
+
+where `next` is null on the last page, and is passed back as ?before=
+(message lists) or ?after= (user lists) to get the next page. Every
+endpoint takes ?fields=a,b to return only those fields.
+
+Likes and follows are set with PUT and cleared with DELETE. Both are
+idempotent and answer with the counts that changed, for the page to
+update in place.
+"""
+
+from flask import Blueprint, abort, current_app, g, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+from db_setup import db
+from api.serialize import Resource, isoformat
+from likes.models import Like
+from likes.routes import like, unlike
+from messages.models import Message
+from pagination import current_position, paginate, per_page, split_page
+from timelines.models import TimelineEntry
+from users.models import User, Follow
+from users.general_routes import follow, unfollow
+
+api_views = Blueprint('api_routes', __name__, url_prefix='/api/v1')
+
+messages = Resource(
+    {
+        'id': Message.id,
+        'text': Message.text,
+        'timestamp': Message.timestamp,
+        'user_id': Message.user_id,
+        'likes_count': Message.likes_count,
+        'username': User.username,
+        'user_image_url': User.image_url,
+    },
+    formats={'timestamp': isoformat},
+)
+
+users = Resource({
+    'id': User.id,
+    'username': User.username,
+    'image_url': User.image_url,
+    'header_image_url': User.header_image_url,
+    'bio': User.bio,
+    'location': User.location,
+    'messages_count': User.messages_count,
+    'following_count': User.following_count,
+    'followers_count': User.followers_count,
+    'likes_count': User.likes_count,
+})
+
+
+@api_views.before_request
+def require_login():
+    """The API is for logged-in users only."""
+
+    if not g.user:
+        return jsonify(error="Login required"), 401
+
+
+@api_views.errorhandler(HTTPException)
+def http_error(error):
+    """Report errors as JSON rather than HTML pages."""
+
+    return jsonify(error=error.description), error.code
+
+
+##############################################################################
+# Helpers
+
+
+def message_query(names):
+    """Query for the `names` fields of messages (and their cursor)."""
+
+    return (db.session
+            .query(*messages.columns(names, 'timestamp', 'id'))
+            .select_from(Message)
+            .join(User, User.id == Message.user_id))
+
+
+def message_page(query, names, timestamp_col=Message.timestamp, key=None):
+    """JSON for a page of `query`'s messages, newest (by `timestamp_col`)
+    first."""
+
+    rows, next_cursor = paginate(query, timestamp_col, Message.id,
+                                 current_position(), key=key)
+    return jsonify(data=messages.dump(names, rows), next=next_cursor)
+
+
+def user_page(query, names):
+    """JSON for a page of `query`'s users, in sign-up order."""
+
+    limit = current_app.config['USERS_PER_PAGE']
+    after = request.args.get('after', 0, type=int)
+    rows = (query
+            .filter(User.id > after)
+            .order_by(User.id)
+            .limit(limit + 1)
+            .all())
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+
+    return jsonify(data=users.dump(names, rows), next=next_cursor)
+
+
+def user_query(names):
+    """Query for the `names` fields of users (and their cursor)."""
+
+    return db.session.query(*users.columns(names, 'id'))
+
+
+##############################################################################
+# Messages
+
+
+@api_views.route('/feed')
+def feed():
+    """The logged-in user's home timeline."""
+
+    names = messages.requested()
+    rows = TimelineEntry.for_user(g.user.id, per_page() + 1,
+                                  current_position(),
+                                  query=message_query(names))
+    rows, next_cursor = split_page(rows, per_page())
+    return jsonify(data=messages.dump(names, rows), next=next_cursor)
+
+
+@api_views.route('/messages/<int:message_id>')
+def show_message(message_id):
+    """One message."""
+
+    names = messages.requested()
+    row = (message_query(names)
+           .filter(Message.id == message_id)
+           .first_or_404())
+    return jsonify(data=messages.dump_one(names, row))
+
+
+@api_views.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """Messages by `user_id`, newest first."""
+
+    names = messages.requested()
+    return message_page(message_query(names)
+                        .filter(Message.user_id == user_id), names)
+
+
+@api_views.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """Messages `user_id` has liked, most recently liked first."""
+
+    names = messages.requested()
+    return message_page(message_query(names)
+                        .add_columns(Like.timestamp.label('liked_at'))
+                        .join(Like, Like.message_id == Message.id)
+                        .filter(Like.user_id == user_id), names,
+                        timestamp_col=Like.timestamp,
+                        key=lambda row: (row.liked_at, row.id))
+
+
+##############################################################################
+# Users
+
+
+@api_views.route('/users')
+def user_list():
+    """Every user, in sign-up order."""
+
+    names = users.requested()
+    return user_page(user_query(names), names)
+
+
+@api_views.route('/users/<int:user_id>')
+def show_user(user_id):
+    """One user's profile."""
+
+    names = users.requested()
+    row = user_query(names).filter(User.id == user_id).first_or_404()
+    return jsonify(data=users.dump_one(names, row))
+
+
+@api_views.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    """The users `user_id` follows."""
+
+    names = users.requested()
+    return user_page(user_query(names)
+                     .join(Follow, Follow.user_being_followed_id == User.id)
+                     .filter(Follow.user_following_id == user_id), names)
+
+
+@api_views.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """The users following `user_id`."""
+
+    names = users.requested()
+    return user_page(user_query(names)
+                     .join(Follow, Follow.user_following_id == User.id)
+                     .filter(Follow.user_being_followed_id == user_id), names)
+
+
+##############################################################################
+# Likes and follows
+
+
+def exists(model, id):
+    """404 unless there's a `model` row with this `id`."""
+
+    if not db.session.query(model.query.filter(model.id == id).exists()
+                            ).scalar():
+        abort(404)
+
+
+def counts(user_id, *columns):
+    """`user_id`'s current counter `columns`, as a dict with their id."""
+
+    row = (db.session
+           .query(User.id, *[getattr(User, column) for column in columns])
+           .filter(User.id == user_id)
+           .one())
+    return dict(zip(row.keys(), row))
+
+
+@api_views.route('/messages/<int:message_id>/like', methods=['PUT', 'DELETE'])
+def like_message(message_id):
+    """Like (PUT) or unlike (DELETE) a message."""
+
+    exists(Message, message_id)
+
+    liked = request.method == 'PUT'
+    if liked:
+        like(message_id)
+    else:
+        unlike(message_id)
+
+    message_likes = (db.session
+                     .query(Message.likes_count)
+                     .filter(Message.id == message_id)
+                     .scalar())
+    return jsonify(data={'message_id': message_id,
+                         'liked': liked,
+                         'likes_count': message_likes,
+                         'user': counts(g.user.id, 'likes_count')})
+
+
+@api_views.route('/users/<int:user_id>/follow', methods=['PUT', 'DELETE'])
+def follow_user(user_id):
+    """Follow (PUT) or unfollow (DELETE) a user."""
+
+    if user_id == g.user.id:
+        abort(400, "You can't follow yourself.")
+
+    exists(User, user_id)
+
+    following = request.method == 'PUT'
+    if following:
+        follow(user_id)
+    else:
+        unfollow(user_id)
+
+    return jsonify(data={'following': following,
+                         'user': counts(g.user.id, 'following_count'),
+                         'followed': counts(user_id, 'followers_count')})
@@ -0,0 +1,65 @@
+"""Turn query rows into JSON-ready dicts, a column at a time.
+
+A `Resource` names the fields a client may ask for, each backed by a
+column expression. Queries select just the requested columns (as plain
+row tuples; no ORM objects are built), and `dump` zips them up with the
+field names.
+"""
+
+from flask import abort, request
+
+
+def isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+class Resource:
+    """The fields of one kind of API object.
+
+    `fields` maps each field name to its column; `formats` maps some of
+    them to a function that turns the column value into JSON.
+    """
+
+    def __init__(self, fields, formats=None):
+        self.fields = fields
+        self.formats = formats or {}
+
+    def requested(self):
+        """The field names asked for with ?fields=a,b (all by default).
+
+        Aborts with a 400 for fields we don't have.
+        """
+
+        fields = request.args.get('fields')
+        if not fields:
+            return list(self.fields)
+
+        names = [name.strip() for name in fields.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields]
+        if unknown or not names:
+            abort(400, f"Unknown fields: {', '.join(unknown)}")
+        return names
+
+    def columns(self, names, *extra):
+        """Labelled columns for `names`, plus `extra` fields the query
+        needs for itself (e.g. to build a cursor)."""
+
+        names = list(names) + [name for name in extra if name not in names]
+        return [self.fields[name].label(name) for name in names]
+
+    def dump(self, names, rows):
+        """The `names` fields of each row, as a list of dicts."""
+
+        # one pass per column, then one zip per row
+        columns = []
+        for name in names:
+            values = [getattr(row, name) for row in rows]
+            format = self.formats.get(name)
+            if format:
+                values = [format(value) for value in values]
+            columns.append(values)
+
+        return [dict(zip(names, values)) for values in zip(*columns)]
+
+    def dump_one(self, names, row):
+        return self.dump(names, [row])[0]
@@ -1,22 +1,36 @@
 import os
 
-from flask import Flask, render_template, session, g, url_for
-from flask_debugtoolbar import DebugToolbarExtension
+import click
+
+from flask import Flask, render_template, request, session, g, url_for
 from sqlalchemy.exc import IntegrityError
 
-from db_setup import db, connect_db
+from db_setup import db, connect_db, pool_metrics
+from pagination import current_position, per_page, split_page
+from fragments import message_cards, user_cards
+from conditional import add_static_fingerprint, set_cache_headers
+from metrics import metrics
 
 
 from users.general_routes import user_views
-from users.auth_routes import auth_views, CURR_USER_KEY
+from users.auth_routes import auth_views, init_login_throttle, CURR_USER_KEY
 
-from users.models import User, Follow
+from users.models import User, Follow, UserGram, FollowSuggestion
+from users.current import get_current_user
+from users.passwords import hasher, PasswordHasherBusy
 from users.forms import LoginForm
 
 from messages.routes import Message
+from messages.models import MessageTerm
+from messages.trending import trending
 from messages.routes import message_views
 
 from likes.routes import like_views
+from likes.models import Like
+
+from api.routes import api_views
+
+from timelines.models import TimelineEntry
 
 
 app = Flask(__name__)
@@ -28,24 +42,133 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
+
+# PostgreSQL connections (see db_setup.Database). Each gunicorn worker can
+# open DB_POOL_SIZE + DB_MAX_OVERFLOW of them (keep that at least its
+# GUNICORN_THREADS, see the Procfile); keep that times the number of
+# workers under the server's max_connections.
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 5))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = True
+# Set DB_PGBOUNCER=1 when DB_URL points at a PgBouncer in transaction
+# pooling mode: it does the pooling instead.
+app.config['DB_PGBOUNCER'] = os.environ.get('DB_PGBOUNCER') == '1'
+# Longest a request's SQL statement may run, in ms (0: no limit).
+app.config['DB_STATEMENT_TIMEOUT'] = int(
+    os.environ.get('DB_STATEMENT_TIMEOUT', 5000))
+# Read replicas of DB_URL, comma separated. GET requests read from them,
+# taking turns ('round-robin') or picking the least busy ('least-loaded');
+# a client that's just written reads from the primary for a while.
+app.config['SQLALCHEMY_BINDS'] = {
+    f'replica{n}': url
+    for n, url in enumerate(filter(None, os.environ.get(
+        'DB_REPLICA_URLS', '').split(',')))}
+app.config['DB_REPLICAS'] = list(app.config['SQLALCHEMY_BINDS'])
+app.config['DB_REPLICA_SELECTION'] = os.environ.get(
+    'DB_REPLICA_SELECTION', 'round-robin')
+app.config['DB_REPLICA_STICKY_SECONDS'] = int(
+    os.environ.get('DB_REPLICA_STICKY_SECONDS', 10))
+# How often (seconds) 'least-loaded' re-reads how busy each replica is,
+# and how long it waits for a replica to answer.
+app.config['DB_REPLICA_PROBE_SECONDS'] = float(
+    os.environ.get('DB_REPLICA_PROBE_SECONDS', 1))
+app.config['DB_REPLICA_PROBE_TIMEOUT'] = int(
+    os.environ.get('DB_REPLICA_PROBE_TIMEOUT', 2))
+# The debug toolbar is only for development: it's on when the app runs in
+# debug mode (FLASK_ENV=development), or when DEBUG_TB_ENABLED=1.
+app.config['DEBUG_TB_ENABLED'] = (
+    app.debug or os.environ.get('DEBUG_TB_ENABLED') == '1')
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
 
+# Authors with at least this many followers aren't fanned out on write;
+# their messages are merged into followers' feeds when the feed is read.
+app.config['TIMELINE_FANOUT_LIMIT'] = int(
+    os.environ.get('TIMELINE_FANOUT_LIMIT', 10000))
+# How many of a user's messages to copy into a new follower's timeline.
+app.config['TIMELINE_BACKFILL'] = 100
+
+# Page size for the feed, profile and likes message lists.
+app.config['MESSAGES_PER_PAGE'] = int(
+    os.environ.get('MESSAGES_PER_PAGE', 100))
+# Page size for the user directory and search results.
+app.config['USERS_PER_PAGE'] = int(os.environ.get('USERS_PER_PAGE', 60))
+# How many "who to follow" suggestions to show on the home page and at the
+# top of the user directory.
+app.config['FOLLOW_SUGGESTIONS_SHOWN'] = 5
+
+# bcrypt cost; existing hashes are upgraded to it when their owner logs in.
+app.config['BCRYPT_LOG_ROUNDS'] = int(
+    os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# Threads that hash passwords, and how many more hashes may wait for one
+# before logins are turned away with a 503.
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 4))
+app.config['PASSWORD_HASH_QUEUE'] = int(
+    os.environ.get('PASSWORD_HASH_QUEUE', 16))
+# ...and how many seconds a login waits for its hash before it gets the 503.
+app.config['PASSWORD_HASH_TIMEOUT'] = float(
+    os.environ.get('PASSWORD_HASH_TIMEOUT', 10))
+
+# The trending page ranks messages posted in the last TRENDING_WINDOW_HOURS
+# by their likes, each worth half as much every TRENDING_HALF_LIFE_HOURS.
+# Workers add up likes in memory (tracking TRENDING_CANDIDATES messages)
+# and write them out every TRENDING_SNAPSHOT_SECONDS.
+app.config['TRENDING_WINDOW_HOURS'] = 24
+app.config['TRENDING_HALF_LIFE_HOURS'] = 6
+app.config['TRENDING_SNAPSHOT_SECONDS'] = int(
+    os.environ.get('TRENDING_SNAPSHOT_SECONDS', 60))
+app.config['TRENDING_CANDIDATES'] = 200
+
+# Login attempts allowed per username and per client IP in any
+# LOGIN_ATTEMPT_WINDOW seconds, and how many of those counters to keep.
+app.config['LOGIN_ATTEMPTS_PER_USERNAME'] = int(
+    os.environ.get('LOGIN_ATTEMPTS_PER_USERNAME', 10))
+app.config['LOGIN_ATTEMPTS_PER_IP'] = int(
+    os.environ.get('LOGIN_ATTEMPTS_PER_IP', 50))
+app.config['LOGIN_ATTEMPT_WINDOW'] = int(
+    os.environ.get('LOGIN_ATTEMPT_WINDOW', 300))
+app.config['LOGIN_THROTTLE_KEYS'] = 100000
+
+# Requests running more SQL statements than this are logged (see metrics).
+app.config['QUERY_BUDGET'] = int(os.environ.get('QUERY_BUDGET', 20))
+# /metrics needs "Authorization: Bearer <this>"; unset, it isn't served.
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+if app.config['DEBUG_TB_ENABLED']:
+    from flask_debugtoolbar import DebugToolbarExtension
+    toolbar = DebugToolbarExtension(app)
+
+app.jinja_env.globals['message_cards'] = message_cards
+app.jinja_env.globals['user_cards'] = user_cards
+app.url_defaults(add_static_fingerprint)
+
+metrics.init_app(app)
+metrics.register(pool_metrics)
 connect_db(app)
+hasher.init_app(app)
+init_login_throttle(app)
+trending.init_app(app)
 
 app.register_blueprint(user_views)
 app.register_blueprint(message_views)
 app.register_blueprint(like_views)
 app.register_blueprint(auth_views)
+app.register_blueprint(api_views)
 
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a cached snapshot (see users.current); routes that need the
+    full row call g.user.load().
+    """
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    if CURR_USER_KEY in session and request.endpoint != 'static':
+        g.user = get_current_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -59,30 +182,77 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
-        # an array of all the Id's of users who's messages should be shown
-        following_ids = [glob[0] for glob in (db.session
-                                              .query(Follow.user_being_followed_id)
-                                              .filter(Follow.user_following_id == g.user.id)
-                                              .all())]
-        following_ids.append(g.user.id)
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages)
+        limit = per_page()
+        messages = TimelineEntry.for_user(g.user.id,
+                                          limit=limit + 1,
+                                          position=current_position())
+        messages, next_cursor = split_page(messages, limit)
+
+        suggestions = FollowSuggestion.for_user(
+            g.user.id, app.config['FOLLOW_SUGGESTIONS_SHOWN'])
+
+        return render_template('home.html',
+                               messages=messages,
+                               liked_ids=Like.liked_ids(g.user, messages),
+                               next_cursor=next_cursor,
+                               suggestions=suggestions)
 
     else:
         return render_template('home-anon.html')
 
 
+@app.cli.command('repair-counts')
+def repair_counts():
+    """Recompute every user's message/follow/like counters and every
+    message's like count."""
+
+    User.recount()
+    Message.recount()
+    db.session.commit()
+
+
+@app.cli.command('suggest-follows')
+@click.option('--all', 'everyone', is_flag=True,
+              help="Redo everyone, not just users whose follows changed.")
+@click.option('--workers', type=int, default=None,
+              help="Worker processes (default: one per CPU).")
+def suggest_follows(everyone, workers):
+    """Recompute "who to follow" suggestions (needs numpy and scipy)."""
+
+    from users.suggestions import suggest_follows
+
+    done = suggest_follows(everyone=everyone, workers=workers)
+    print(f"Updated suggestions for {done} users.")
+
+
+@app.cli.command('reindex-users')
+def reindex_users():
+    """Rebuild the user search index."""
+
+    UserGram.rebuild()
+    db.session.commit()
+
+
+@app.cli.command('reindex-messages')
+def reindex_messages():
+    """Rebuild the message search index."""
+
+    MessageTerm.rebuild()
+    db.session.commit()
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Rebuild every user's home timeline from follows and messages."""
+
+    TimelineEntry.rebuild()
+    db.session.commit()
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -90,12 +260,16 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Too many logins/signups at once: ask the client to retry."""
+
+    return ("Too many people are signing in right now. "
+            "Please try again in a moment.", 503, {'Retry-After': '1'})
+
+
 @app.after_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add caching headers to every response (see conditional)."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    return set_cache_headers(req)
@@ -0,0 +1,165 @@
+"""Compare query plans for Warbler's hot queries with and without the
+composite indexes on messages, follows and likes.
+
+Needs a PostgreSQL database (EXPLAIN ANALYZE output is PostgreSQL's):
+
+    DB_URL=postgresql:///warbler-bench python -m benchmarks.query_plans --seed
+
+--seed fills the (empty) database with synthetic rows using
+generate_series, by default 100k users, 1M messages and 10M follows.
+Without it the script uses whatever data is already there.
+
+For every query the script prints the plan's top node and execution time
+twice: once with the indexes dropped (inside a transaction that's rolled
+back afterwards) and once with them in place.
+"""
+
+import argparse
+import json
+
+from app import app, db
+
+INDEXES = ('ix_messages_user_timestamp',
+           'ix_follows_following',
+           'ix_likes_message_user')
+
+QUERIES = {
+    'who does X follow': """
+        SELECT user_being_followed_id
+        FROM follows
+        WHERE user_following_id = :user_id
+    """,
+    'profile messages': """
+        SELECT id
+        FROM messages
+        WHERE user_id = :user_id
+        ORDER BY timestamp DESC, id DESC
+        LIMIT 100
+    """,
+    'home feed (fan-out-on-read)': """
+        SELECT id
+        FROM messages
+        WHERE user_id IN (SELECT user_being_followed_id
+                          FROM follows
+                          WHERE user_following_id = :user_id)
+        ORDER BY timestamp DESC
+        LIMIT 100
+    """,
+    'liked message ids': """
+        SELECT message_id
+        FROM likes
+        WHERE user_id = :user_id
+    """,
+    'who liked a message': """
+        SELECT user_id
+        FROM likes
+        WHERE message_id = (SELECT message_id
+                            FROM likes
+                            GROUP BY message_id
+                            ORDER BY count(*) DESC
+                            LIMIT 1)
+    """,
+}
+
+
+def seed(conn, users, messages, follows):
+    """Fill an empty database with synthetic users, messages and follows."""
+
+    print(f'Seeding {users} users, {messages} messages, {follows} follows...')
+    conn.execute("""
+        INSERT INTO users (id, email, username, password)
+        SELECT n, 'user' || n || '@example.com', 'user' || n, 'x'
+        FROM generate_series(1, %(users)s) AS n
+    """, users=users)
+    conn.execute("""
+        INSERT INTO messages (text, timestamp, user_id)
+        SELECT 'message ' || n,
+               now() - n * interval '1 second',
+               1 + floor(random() * %(users)s)::int
+        FROM generate_series(1, %(messages)s) AS n
+    """, users=users, messages=messages)
+    # followed users are skewed towards low ids, so some accounts have
+    # a lot of followers and most have a few
+    conn.execute("""
+        INSERT INTO follows (user_being_followed_id, user_following_id)
+        SELECT DISTINCT
+               1 + floor(%(users)s * power(random(), 3))::int,
+               1 + floor(random() * %(users)s)::int
+        FROM generate_series(1, %(follows)s)
+        ON CONFLICT DO NOTHING
+    """, users=users, follows=follows)
+    conn.execute("""
+        INSERT INTO likes (user_id, message_id)
+        SELECT 1 + floor(random() * %(users)s)::int, id
+        FROM messages TABLESAMPLE SYSTEM (10)
+        ON CONFLICT DO NOTHING
+    """, users=users)
+    conn.execute('ANALYZE')
+
+
+def busiest_user(conn):
+    """The user who follows the most people (the slowest feed to build)."""
+
+    return conn.execute("""
+        SELECT user_following_id
+        FROM follows
+        GROUP BY user_following_id
+        ORDER BY count(*) DESC
+        LIMIT 1
+    """).scalar()
+
+
+def explain(conn, sql, user_id):
+    """Run EXPLAIN ANALYZE; return (top plan node, execution time in ms)."""
+
+    result = conn.execute(
+        db.text(f'EXPLAIN (ANALYZE, FORMAT JSON) {sql}'),
+        user_id=user_id).scalar()
+    if isinstance(result, str):
+        result = json.loads(result)
+    plan = result[0]
+    return plan['Plan']['Node Type'], plan['Execution Time']
+
+
+def compare(conn, user_id):
+    """Print each query's plan without and then with the indexes."""
+
+    for name, sql in QUERIES.items():
+        print(f'\n{name} (user {user_id})')
+
+        trans = conn.begin()
+        for index in INDEXES:
+            conn.execute(f'DROP INDEX IF EXISTS {index}')
+        node, ms = explain(conn, sql, user_id)
+        trans.rollback()
+        print(f'  without indexes: {ms:10.2f} ms  {node}')
+
+        node, ms = explain(conn, sql, user_id)
+        print(f'  with indexes:    {ms:10.2f} ms  {node}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seed', action='store_true',
+                        help='fill an empty database with synthetic data')
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--follows', type=int, default=10_000_000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        engine = db.engine
+        if engine.dialect.name != 'postgresql':
+            parser.error('query plans need a PostgreSQL DB_URL')
+
+        if args.seed:
+            db.create_all()
+            with engine.begin() as conn:
+                seed(conn, args.users, args.messages, args.follows)
+
+        with engine.connect() as conn:
+            compare(conn, busiest_user(conn))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,494 @@
+"""Benchmark Warbler's main routes: latency, throughput and queries.
+
+    # fill a scratch database with a synthetic dataset (drops every table!)
+    DB_URL=postgresql:///warbler-bench python -m benchmarks.routes --seed
+
+    # measure, and save the results as the baseline
+    DB_URL=postgresql:///warbler-bench python -m benchmarks.routes \\
+        --save-baseline benchmarks/baseline.json
+
+    # measure again later; exits 1 if any route regressed
+    DB_URL=postgresql:///warbler-bench python -m benchmarks.routes \\
+        --compare benchmarks/baseline.json
+
+--seed is reproducible: the same sizes and --random-seed give the same
+rows. Every route is requested as the user who follows the most people
+(the slowest home feed), against the most followed user's profile and
+the most liked message.
+
+Routes are driven two ways (--mode):
+
+- client: Flask's test client, one request at a time in this process.
+  This is the app's own cost, and where the SQL statements per request
+  are counted (see metrics).
+- gunicorn: real HTTP against `gunicorn app:app` started on a local
+  port, from --concurrency threads. This adds the server, sockets and
+  concurrent access to the database.
+
+For each route the report gives p50/p95/p99 latency in ms, requests per
+second and SQL statements per request. Latency and throughput only
+compare between runs on the same machine and database, so keep a
+baseline per machine. A route has regressed when its p95 or throughput
+is more than --threshold worse than the baseline's, or it runs more
+than QUERY_SLACK more statements per request.
+
+like_message and add_follow change data; the benchmark puts the like and
+the follows back as they were when it's done.
+"""
+
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from time import monotonic, perf_counter, sleep
+
+from app import app, db, CURR_USER_KEY
+from metrics import metrics
+from seed import fix_sequences
+from users.models import User, Follow, UserGram
+from messages.models import Message, MessageTerm
+from likes.models import Like
+from timelines.models import TimelineEntry
+
+# allowed rise in SQL statements per request before a route has regressed
+QUERY_SLACK = 0.5
+# rows per INSERT when seeding
+BATCH_SIZE = 5000
+
+
+##############################################################################
+# Dataset
+
+
+def seed(users, messages, follows, likes, random_seed=0):
+    """Replace the database's contents with a synthetic dataset."""
+
+    rng = random.Random(random_seed)
+    now = datetime.utcnow()
+
+    print(f'Seeding {users} users, {messages} messages, {follows} follows, '
+          f'{likes} likes...')
+    db.drop_all()
+    db.create_all()
+
+    insert(User, ({'id': n,
+                   'email': f'user{n}@example.com',
+                   'username': f'user{n}',
+                   # nobody logs in: sessions are signed directly
+                   'password': 'x'}
+                  for n in range(1, users + 1)))
+    insert(Message, ({'id': n,
+                      'text': f'message {n} ' + ' '.join(
+                          rng.choices(WORDS, k=rng.randint(3, 15))),
+                      'timestamp': now - timedelta(
+                          seconds=rng.randrange(30 * 24 * 3600)),
+                      'user_id': rng.randint(1, users)}
+                     for n in range(1, messages + 1)))
+
+    # followed users are skewed towards low ids, so some accounts have a
+    # lot of followers and most have a few
+    pairs = unique_pairs(
+        follows,
+        lambda: (rng.randint(1, users),
+                 1 + int(users * rng.random() ** 3)))
+    insert(Follow, ({'user_following_id': follower,
+                     'user_being_followed_id': followed}
+                    for follower, followed in pairs
+                    if follower != followed))
+    pairs = unique_pairs(
+        likes,
+        lambda: (rng.randint(1, users), rng.randint(1, messages)))
+    insert(Like, ({'user_id': user_id, 'message_id': message_id}
+                  for user_id, message_id in pairs))
+
+    fix_sequences(db.engine)
+    print('Counting, indexing for search and building timelines...')
+    User.recount()
+    Message.recount()
+    UserGram.rebuild()
+    MessageTerm.rebuild()
+    TimelineEntry.rebuild()
+    db.session.commit()
+
+
+WORDS = ('warble', 'bird', 'song', 'morning', 'tree', 'nest', 'flock',
+         'feather', 'sky', 'chirp', 'seed', 'branch', 'dawn', 'wing')
+
+
+def unique_pairs(n, make):
+    """Up to `n` distinct pairs from calling `make`."""
+
+    pairs = set()
+    for _ in range(n):
+        pairs.add(make())
+    return sorted(pairs)
+
+
+def insert(model, rows):
+    """INSERT `rows` (dicts) into `model`'s table, in batches."""
+
+    table = model.__table__
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+    db.session.commit()
+
+
+class Subjects:
+    """Who and what the routes are requested about."""
+
+    def __init__(self):
+        self.user_id = (db.session
+                        .query(Follow.user_following_id)
+                        .group_by(Follow.user_following_id)
+                        .order_by(db.func.count().desc(),
+                                  Follow.user_following_id)
+                        .limit(1)
+                        .scalar())
+        self.other_id = (db.session
+                         .query(User.id)
+                         .filter(User.id != self.user_id)
+                         .order_by(User.followers_count.desc(), User.id)
+                         .limit(1)
+                         .scalar())
+        self.message_id = (db.session
+                           .query(Message.id)
+                           .order_by(Message.likes_count.desc(), Message.id)
+                           .limit(1)
+                           .scalar())
+        if None in (self.user_id, self.other_id, self.message_id):
+            sys.exit('The database needs users, messages and follows; '
+                     'run with --seed first.')
+
+        followed = (db.session
+                    .query(Follow.user_being_followed_id)
+                    .filter(Follow.user_following_id == self.user_id))
+        # users to follow: ones they don't already
+        self.follow_ids = [id for id, in (db.session
+                                          .query(User.id)
+                                          .filter(User.id != self.user_id,
+                                                  ~User.id.in_(followed))
+                                          .order_by(User.id)
+                                          .limit(100))]
+        self.liked = self.likes_message()
+
+    def likes_message(self):
+        return db.session.query(
+            Like.query
+            .filter_by(user_id=self.user_id, message_id=self.message_id)
+            .exists()).scalar()
+
+
+##############################################################################
+# Routes
+
+
+# name: (endpoint, method, path for Subjects s and request number i)
+ROUTES = {
+    'homepage': ('homepage', 'GET', lambda s, i: '/'),
+    'users_show': ('user_routes.users_show', 'GET',
+                   lambda s, i: f'/users/{s.other_id}'),
+    'show_following': ('user_routes.show_following', 'GET',
+                       lambda s, i: f'/users/{s.other_id}/following'),
+    'users_followers': ('user_routes.users_followers', 'GET',
+                        lambda s, i: f'/users/{s.other_id}/followers'),
+    'show_likes': ('user_routes.show_likes', 'GET',
+                   lambda s, i: f'/users/{s.user_id}/likes'),
+    'list_users': ('user_routes.list_users', 'GET', lambda s, i: '/users'),
+    'messages_show': ('message_routes.messages_show', 'GET',
+                      lambda s, i: f'/messages/{s.message_id}'),
+    # (likes and unlikes in turn)
+    'like_message': ('like_routes.like_message', 'POST',
+                     lambda s, i: f'/users/add_like/{s.message_id}'),
+    'add_follow': ('user_routes.add_follow', 'POST',
+                   lambda s, i: ('/users/follow/'
+                                 f'{s.follow_ids[i % len(s.follow_ids)]}')),
+}
+
+
+def restore(client, subjects):
+    """Undo the like_message and add_follow requests."""
+
+    if subjects.likes_message() != subjects.liked:
+        client.post(f'/users/add_like/{subjects.message_id}')
+    for follow_id in subjects.follow_ids:
+        client.post(f'/users/stop-following/{follow_id}')
+
+    # The requests ran inside our app context, so their session (and any
+    # transaction a no-op write left open) is still ours; end it.
+    db.session.remove()
+
+
+##############################################################################
+# Drivers
+
+
+def logged_in_client(user_id):
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+    return client
+
+
+def run_client(subjects, names, requests, warmup):
+    """Time `requests` of each route through the test client; returns
+    {name: (latencies, seconds, statements per request)}."""
+
+    client = logged_in_client(subjects.user_id)
+    results = {}
+
+    for name in names:
+        endpoint, method, path = ROUTES[name]
+        for i in range(warmup):
+            client.open(path(subjects, i), method=method)
+
+        metrics.clear()
+        latencies = []
+        start = perf_counter()
+        for i in range(requests):
+            began = perf_counter()
+            client.open(path(subjects, i), method=method)
+            latencies.append(perf_counter() - began)
+        seconds = perf_counter() - start
+
+        labels = (endpoint, method)
+        queries = (metrics.queries.total(*labels)
+                   / max(metrics.queries.count(*labels), 1))
+        results[name] = (latencies, seconds, queries)
+
+    restore(client, subjects)
+    return results
+
+
+def session_cookie(user_id):
+    """A `Cookie:` header value logging in as `user_id`."""
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    value = serializer.dumps({CURR_USER_KEY: user_id})
+    return f'{app.session_cookie_name}={value}'
+
+
+def start_gunicorn(port, workers):
+    """Run `gunicorn app:app` on `port`; returns once it's answering."""
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+         '--bind', f'127.0.0.1:{port}', 'app:app'],
+        env=dict(os.environ, QUERY_BUDGET='1000000'),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = monotonic() + 30
+    while monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit(f'gunicorn exited with status {server.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            sleep(0.1)
+
+    server.terminate()
+    sys.exit('gunicorn did not start listening within 30 seconds')
+
+
+def run_gunicorn(subjects, names, requests, warmup, concurrency, workers,
+                 port):
+    """Time `requests` of each route over HTTP from `concurrency` threads;
+    returns {name: (latencies, seconds, None)}."""
+
+    cookie = session_cookie(subjects.user_id)
+    server = start_gunicorn(port, workers)
+    results = {}
+
+    def drive(method, path, numbers):
+        # one keep-alive connection per thread
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        latencies = []
+        for i in iter(lambda: next(numbers), None):
+            began = perf_counter()
+            conn.request(method, path(subjects, i),
+                         headers={'Cookie': cookie})
+            conn.getresponse().read()
+            latencies.append(perf_counter() - began)
+        conn.close()
+        return latencies
+
+    try:
+        with ThreadPoolExecutor(concurrency) as pool:
+            for name in names:
+                endpoint, method, path = ROUTES[name]
+                drive(method, path, RequestNumbers(warmup))
+
+                shared = RequestNumbers(requests)
+                start = perf_counter()
+                futures = [pool.submit(drive, method, path, shared)
+                           for _ in range(concurrency)]
+                latencies = [latency
+                             for future in futures
+                             for latency in future.result()]
+                results[name] = (latencies, perf_counter() - start, None)
+    finally:
+        server.terminate()
+        server.wait()
+
+    restore(logged_in_client(subjects.user_id), subjects)
+    return results
+
+
+class RequestNumbers:
+    """0, 1, ... up to `n`, handed out to several threads; then None."""
+
+    def __init__(self, n):
+        self._numbers = iter(range(n))
+
+    def __next__(self):
+        # (next() on a range iterator is atomic)
+        return next(self._numbers, None)
+
+
+##############################################################################
+# Reporting
+
+
+def percentile(sorted_values, p):
+    """The nearest-rank `p`th percentile of `sorted_values`."""
+
+    rank = max(math.ceil(p / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(results):
+    """{name: {p50, p95, p99 (ms), throughput (req/s), queries}}."""
+
+    summary = {}
+    for name, (latencies, seconds, queries) in results.items():
+        latencies = sorted(latencies)
+        summary[name] = {
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'throughput': len(latencies) / seconds,
+            'queries': queries,
+        }
+    return summary
+
+
+def report(mode, summary):
+    print(f'\n{mode}')
+    print(f'  {"route":<16} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+          f'{"req/s":>8} {"queries":>8}')
+    for name, stats in summary.items():
+        queries = ('' if stats['queries'] is None
+                   else f'{stats["queries"]:.1f}')
+        print(f'  {name:<16} {stats["p50"]:8.2f} {stats["p95"]:8.2f} '
+              f'{stats["p99"]:8.2f} {stats["throughput"]:8.1f} '
+              f'{queries:>8}')
+
+
+def regressions(results, baseline, threshold):
+    """Descriptions of every way `results` are worse than `baseline`."""
+
+    found = []
+    for mode, summary in results.items():
+        for name, stats in summary.items():
+            before = baseline.get(mode, {}).get(name)
+            if before is None:
+                continue
+
+            where = f'{mode} {name}'
+            if stats['p95'] > before['p95'] * (1 + threshold):
+                found.append(f'{where}: p95 {before["p95"]:.2f}ms -> '
+                             f'{stats["p95"]:.2f}ms')
+            if stats['throughput'] < before['throughput'] * (1 - threshold):
+                found.append(f'{where}: throughput '
+                             f'{before["throughput"]:.1f} -> '
+                             f'{stats["throughput"]:.1f} req/s')
+            if (stats['queries'] is not None
+                    and before['queries'] is not None
+                    and stats['queries'] > before['queries'] + QUERY_SLACK):
+                found.append(f'{where}: {before["queries"]:.1f} -> '
+                             f'{stats["queries"]:.1f} queries per request')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seed', action='store_true',
+                        help='replace the database with a synthetic dataset')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=50_000)
+    parser.add_argument('--follows', type=int, default=40_000)
+    parser.add_argument('--likes', type=int, default=40_000)
+    parser.add_argument('--random-seed', type=int, default=0)
+    parser.add_argument('--mode', choices=('client', 'gunicorn', 'both'),
+                        default='both')
+    parser.add_argument('--routes', nargs='+', choices=ROUTES,
+                        default=list(ROUTES))
+    parser.add_argument('--requests', type=int, default=200,
+                        help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='untimed requests per route first')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='client threads (gunicorn mode)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='gunicorn worker processes')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--compare', metavar='PATH',
+                        help='baseline to compare with; exit 1 on regression')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fraction worse than the baseline that counts '
+                             'as a regression')
+    args = parser.parse_args()
+
+    # over-budget requests are the point here, not worth a log line each
+    app.config['QUERY_BUDGET'] = None
+
+    with app.app_context():
+        if args.seed:
+            seed(args.users, args.messages, args.follows, args.likes,
+                 args.random_seed)
+
+        subjects = Subjects()
+        results = {}
+        if args.mode in ('client', 'both'):
+            results['client'] = summarize(run_client(
+                subjects, args.routes, args.requests, args.warmup))
+            report('client', results['client'])
+        if args.mode in ('gunicorn', 'both'):
+            results['gunicorn'] = summarize(run_gunicorn(
+                subjects, args.routes, args.requests, args.warmup,
+                args.concurrency, args.workers, args.port))
+            report('gunicorn', results['gunicorn'])
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+        print(f'\nSaved baseline to {args.save_baseline}')
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        found = regressions(results, baseline, args.threshold)
+        if found:
+            print(f'\nRegressed by more than {args.threshold:.0%}:')
+            for line in found:
+                print(f'  {line}')
+            sys.exit(1)
+        print('\nNo regressions against the baseline.')
+
+
+if __name__ == '__main__':
+    main()
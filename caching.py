@@ -0,0 +1,63 @@
+"""Small in-process caches for Warbler.
+
+These live inside a single worker process, so every entry has a TTL: a
+write made through another worker is picked up once the entry expires.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class TTLCache:
+    """A thread-safe LRU cache whose entries also expire after `ttl` seconds.
+
+    Once `maxsize` entries are stored, the least recently used one is
+    evicted to make room.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Get the cached value for `key`, or `default` if missing/expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            expires_at, value = entry
+            if expires_at <= monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Cache `value` under `key`, evicting the oldest entry if full."""
+
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Drop `key` from the cache, if it's there."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop everything."""
+
+        with self._lock:
+            self._entries.clear()
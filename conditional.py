@@ -0,0 +1,105 @@
+"""HTTP caching for Warbler's responses.
+
+Pages that are expensive to render but rarely change (a message, a
+profile) get a weak ETag built from the data they show; when the browser
+already has that version, the route answers 304 without rendering.
+
+Static files are linked with a fingerprint of their contents
+(?v=<hash>), so they can be cached for a year: a changed file gets a new
+URL.
+"""
+
+import hashlib
+import os
+from functools import lru_cache
+
+from flask import current_app, g, request, session
+
+# A year: as long as caches will keep anything.
+STATIC_MAX_AGE = 31536000
+
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()[:16]
+
+
+@lru_cache(maxsize=None)
+def static_fingerprint(filename):
+    """A short hash of the contents of static file `filename`."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    try:
+        with open(path, 'rb') as f:
+            return _digest(f.read())
+    except OSError:
+        return None
+
+
+@lru_cache(maxsize=None)
+def templates_fingerprint():
+    """A short hash of every template, so deploys change page ETags."""
+
+    folder = os.path.join(current_app.root_path, current_app.template_folder)
+    hashed = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(folder)):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                hashed.update(name.encode())
+                hashed.update(f.read())
+    return hashed.hexdigest()[:16]
+
+
+def add_static_fingerprint(endpoint, values):
+    """url_for() hook: add ?v=<fingerprint> to static file URLs."""
+
+    if endpoint == 'static' and 'filename' in values:
+        fingerprint = static_fingerprint(values['filename'])
+        if fingerprint:
+            values.setdefault('v', fingerprint)
+
+
+def not_modified(*parts):
+    """Tag this response with a weak ETag made from `parts`.
+
+    `parts` should be everything the page shows that can change; who's
+    looking is added here. Returns True if the client already has this
+    version, in which case the route should return a 304.
+    """
+
+    viewer = g.user.state() if g.user else None
+    g.etag = _digest(repr((templates_fingerprint(), viewer, parts)).encode())
+
+    # a pending flash message would be lost on a cached page
+    if session.get('_flashes'):
+        return False
+    return request.if_none_match.contains_weak(g.etag)
+
+
+def set_cache_headers(response):
+    """after_request hook: pick the caching policy for `response`."""
+
+    if request.endpoint == 'static':
+        if request.args.get('v'):
+            # (written out whole: the pinned Werkzeug's cache_control
+            # doesn't know `immutable`)
+            response.headers['Cache-Control'] = (
+                f'public, max-age={STATIC_MAX_AGE}, immutable')
+        return response
+
+    if g.get('etag'):
+        response.set_etag(g.etag, weak=True)
+        # can be stored, but must be checked with the ETag before reuse;
+        # logged-in pages are only for that user's browser
+        response.cache_control.no_cache = True
+        if g.user:
+            response.cache_control.private = True
+        else:
+            response.cache_control.public = True
+    elif g.get('user'):
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    else:
+        response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        response.headers["Pragma"] = "no-cache"
+        response.headers["Expires"] = "0"
+    return response
@@ -1,8 +1,296 @@
 """SQLAlchemy models for Warbler."""
 
-from flask_sqlalchemy import SQLAlchemy
+from threading import Lock, Thread
+from time import monotonic, time
 
-db = SQLAlchemy()
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql.dml import UpdateBase
+
+from metrics import gauge
+
+# (Flask) session key: reads stay on the primary until this time
+PRIMARY_UNTIL_KEY = 'db_primary_until'
+
+
+class ReplicaSelector:
+    """Chooses a read replica for each request, from the bind `names`.
+
+    With 'round-robin' they take turns. With 'least-loaded', it's the one
+    with the lowest load (taking turns between equals): what `probe(name)`
+    last reported plus the requests using it in this process right now.
+
+    The probe is what makes 'least-loaded' work across processes: under
+    sync gunicorn workers each process only ever has one request in
+    flight, so its own count can't tell the replicas apart. For
+    PostgreSQL, Database probes the busy connections on each replica,
+    from every client. Without a probe (or when it returns None) only
+    this process's requests count, which only helps threaded workers.
+
+    Probes run in a background thread, at most every `probe_seconds`, so
+    a slow replica never holds up a request. One whose probe fails counts
+    as infinitely loaded, and isn't probed again for a while (doubling,
+    up to PROBE_BACKOFF_MAX seconds, while it keeps failing).
+    """
+
+    PROBE_BACKOFF_MAX = 60
+
+    def __init__(self, names, strategy='round-robin', probe=None,
+                 probe_seconds=1):
+        if strategy not in ('round-robin', 'least-loaded'):
+            raise ValueError(f"Unknown replica selection: {strategy}")
+
+        self.names = list(names)
+        self.strategy = strategy
+        self.probe = probe
+        self.probe_seconds = probe_seconds
+        self._lock = Lock()
+        self._turn = 0
+        self._in_use = dict.fromkeys(self.names, 0)
+        self._probed = dict.fromkeys(self.names, 0)
+        self._probed_at = None
+        self._prober = None
+        # name -> (failures in a row, when to probe it again)
+        self._backoff = {}
+
+    def _load(self, name):
+        return self._probed[name] + self._in_use[name]
+
+    def _refresh(self):
+        """Start re-reading the replicas' loads, if `probe_seconds` have
+        passed and no probe is running. (Called holding the lock.)"""
+
+        now = monotonic()
+        if (self.probe is None
+                or (self._prober and self._prober.is_alive())
+                or (self._probed_at is not None
+                    and now - self._probed_at < self.probe_seconds)):
+            return
+        self._probed_at = now
+        self._prober = Thread(target=self._probe_all, name='replica-probe',
+                              daemon=True)
+        self._prober.start()
+
+    def _probe_all(self):
+        loads = {}
+        failed = []
+        for name in self.names:
+            failures, retry_at = self._backoff.get(name, (0, 0))
+            if retry_at > monotonic():
+                continue
+            try:
+                load = self.probe(name)
+            except Exception:
+                failed.append(name)
+                continue
+            loads[name] = 0 if load is None else load
+
+        with self._lock:
+            for name, load in loads.items():
+                self._probed[name] = load
+                self._backoff.pop(name, None)
+            for name in failed:
+                failures = self._backoff.get(name, (0, 0))[0] + 1
+                wait = min(max(self.probe_seconds, 1) * 2 ** failures,
+                           self.PROBE_BACKOFF_MAX)
+                self._backoff[name] = (failures, monotonic() + wait)
+                self._probed[name] = float('inf')
+
+    def acquire(self):
+        """A replica's bind name for a request to read from; pass it to
+        `release` when the request's done."""
+
+        with self._lock:
+            turn = self._turn
+            self._turn = (turn + 1) % len(self.names)
+            order = self.names[turn:] + self.names[:turn]
+
+            if self.strategy == 'least-loaded':
+                self._refresh()
+                name = min(order, key=self._load)
+            else:
+                name = order[0]
+            self._in_use[name] += 1
+            return name
+
+    def release(self, name):
+        with self._lock:
+            self._in_use[name] -= 1
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from the request's replica, if it has one.
+
+    Writes, flushes and SELECT ... FOR UPDATE always go to the primary,
+    and once the session has used the primary, the rest of its reads do
+    too, so they see what it wrote.
+    """
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.db = db
+        self._primary_only = False
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('db_replica') if has_request_context() else None
+
+        if replica and not self._primary_only:
+            if (self._flushing
+                    or isinstance(clause, UpdateBase)
+                    or getattr(clause, '_for_update_arg', None) is not None):
+                self._primary_only = True
+            else:
+                return self.db.get_engine(self.app, bind=replica)
+
+        return super().get_bind(mapper, clause)
+
+
+class Database(SQLAlchemy):
+    """Flask-SQLAlchemy, with the engine configured for production.
+
+    For PostgreSQL (SQLite keeps Flask-SQLAlchemy's defaults):
+
+    - Each worker process keeps up to DB_POOL_SIZE connections open, and
+      opens up to DB_MAX_OVERFLOW more when they're all in use. A
+      request waits DB_POOL_TIMEOUT seconds for one before failing.
+    - Connections are replaced after DB_POOL_RECYCLE seconds.
+    - DB_POOL_PRE_PING tests each connection as it's checked out, so one
+      that died (say, in a failover) is replaced instead of failing a
+      request.
+    - DB_PGBOUNCER is for connecting through a PgBouncer in transaction
+      pooling mode. PgBouncer does the pooling, so the app keeps no pool
+      of its own (NullPool) and sets nothing that outlives a transaction.
+
+    DB_REPLICAS names SQLALCHEMY_BINDS that are read replicas of the
+    primary. GET (and HEAD) requests read from one of them, picked by
+    DB_REPLICA_SELECTION (see ReplicaSelector); everything else uses the
+    primary. After a client makes any other request, its reads stay on
+    the primary for DB_REPLICA_STICKY_SECONDS, so it sees its own writes
+    while the replicas catch up.
+    """
+
+    def init_app(self, app):
+        super().init_app(app)
+
+        app.before_request(self._route_reads)
+        app.after_request(self._stick_to_primary)
+        app.teardown_request(self._release_replica)
+        self.configure_replicas(app)
+
+    def configure_replicas(self, app):
+        """Set up `app`'s read replicas from its config."""
+
+        names = app.config.get('DB_REPLICAS') or ()
+        app.extensions['db_replicas'] = (
+            ReplicaSelector(names,
+                            app.config.get('DB_REPLICA_SELECTION',
+                                           'round-robin'),
+                            lambda name: self.replica_load(app, name),
+                            app.config.get('DB_REPLICA_PROBE_SECONDS', 1))
+            if names else None)
+
+    def replica_load(self, app, name):
+        """How many connections are running a statement on the replica
+        `name`, from any client; None if that can't be told.
+
+        Uses a connection of its own (not one from the pool), which gives
+        up after DB_REPLICA_PROBE_TIMEOUT seconds.
+        """
+
+        engine = self.get_engine(app, bind=name)
+        if engine.dialect.name != 'postgresql':
+            return None
+
+        timeout = app.config.get('DB_REPLICA_PROBE_TIMEOUT', 2)
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        cparams = dict(cparams, connect_timeout=int(timeout),
+                       options=f'-c statement_timeout={int(timeout * 1000)}')
+        # (straight to the driver: this isn't one of the app's queries)
+        conn = engine.dialect.connect(*cargs, **cparams)
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT count(*) FROM pg_stat_activity "
+                           "WHERE state = 'active' "
+                           "AND pid <> pg_backend_pid()")
+            load = cursor.fetchone()[0]
+            cursor.close()
+        finally:
+            conn.close()
+        return load
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+
+        if info.drivername.startswith('postgres'):
+            options.update(engine_options(app.config))
+
+    @staticmethod
+    def _route_reads():
+        replicas = current_app.extensions.get('db_replicas')
+        if (replicas
+                and request.method in ('GET', 'HEAD')
+                and session.get(PRIMARY_UNTIL_KEY, 0) <= time()):
+            g.db_replica = replicas.acquire()
+
+    @staticmethod
+    def _stick_to_primary(response):
+        if (current_app.extensions.get('db_replicas')
+                and request.method not in ('GET', 'HEAD', 'OPTIONS')):
+            session[PRIMARY_UNTIL_KEY] = (
+                time() + current_app.config['DB_REPLICA_STICKY_SECONDS'])
+        return response
+
+    @staticmethod
+    def _release_replica(exc):
+        replica = g.pop('db_replica', None)
+        if replica:
+            current_app.extensions['db_replicas'].release(replica)
+
+
+def engine_options(config):
+    """create_engine() options for PostgreSQL from the app's `config`."""
+
+    if config.get('DB_PGBOUNCER'):
+        return {'poolclass': NullPool}
+
+    options = {'pool_pre_ping': config.get('DB_POOL_PRE_PING', True)}
+    for option, key in (('pool_size', 'DB_POOL_SIZE'),
+                        ('max_overflow', 'DB_MAX_OVERFLOW'),
+                        ('pool_recycle', 'DB_POOL_RECYCLE'),
+                        ('pool_timeout', 'DB_POOL_TIMEOUT')):
+        if config.get(key) is not None:
+            options[option] = config[key]
+    return options
+
+
+db = Database()
+
+
+def insert_ignore(model, **values):
+    """INSERT a `model` row, unless it would clash with one that exists.
+
+    One statement, safe against concurrent inserts of the same row.
+    Returns True if the row was inserted.
+    """
+
+    table = model.__table__
+    dialect = db.session.get_bind(mapper=model.__mapper__).dialect.name
+
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table).values(**values).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        statement = table.insert().values(**values).prefix_with('OR IGNORE')
+    else:
+        statement = table.insert().values(**values).prefix_with('IGNORE')
+
+    return db.session.execute(statement).rowcount == 1
 
 
 def connect_db(app):
@@ -13,3 +301,54 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+
+    if not event.contains(Engine, 'begin', set_statement_timeout):
+        event.listen(Engine, 'begin', set_statement_timeout)
+
+
+def set_statement_timeout(conn):
+    """Limit each statement a request runs to DB_STATEMENT_TIMEOUT ms.
+
+    It's set at the start of every transaction (with SET LOCAL, so it
+    also works through PgBouncer), and only in requests: CLI commands
+    and batch jobs can take as long as they need.
+    """
+
+    if not has_request_context() or conn.dialect.name != 'postgresql':
+        return
+
+    timeout = current_app.config.get('DB_STATEMENT_TIMEOUT')
+    if timeout:
+        # (straight to the driver: this isn't one of the app's queries)
+        cursor = conn.connection.cursor()
+        cursor.execute('SET LOCAL statement_timeout = %s', (int(timeout),))
+        cursor.close()
+
+
+def pool_metrics():
+    """Connection pool gauges for /metrics, for each database engine."""
+
+    values = {name: {} for name in
+              ('size', 'checkedin', 'checkedout', 'overflow')}
+    binds = current_app.config.get('SQLALCHEMY_BINDS') or {}
+
+    for bind in [None, *binds]:
+        pool = db.get_engine(current_app, bind).pool
+        if not hasattr(pool, 'checkedout'):
+            # (NullPool and friends keep no connections)
+            continue
+        labels = (('bind', bind or 'default'),)
+        for name in values:
+            values[name][labels] = getattr(pool, name)()
+
+    yield from gauge('warbler_db_pool_size',
+                     'Connections the pool keeps open.', values['size'])
+    yield from gauge('warbler_db_pool_idle',
+                     'Open connections waiting in the pool.',
+                     values['checkedin'])
+    yield from gauge('warbler_db_pool_in_use',
+                     'Connections checked out of the pool.',
+                     values['checkedout'])
+    yield from gauge('warbler_db_pool_overflow',
+                     'Connections open beyond the pool size (negative: '
+                     'room left before reaching it).', values['overflow'])
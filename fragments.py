@@ -0,0 +1,101 @@
+"""Cached fragments of rendered HTML.
+
+A fragment is the part of a card that looks the same to every viewer. It's
+cached under a key (e.g. ('message', 12)) along with a version, and
+re-rendered when the version it's asked for changes. Viewer-specific bits
+(like and follow buttons) are spliced in at the fragment's {{ slot }}
+markers.
+
+Fragment templates must only use the context they're given: no g.user,
+no request.
+
+Buttons come in two states (liked or not, following or not), so each is
+rendered once per page in both, with a marker where the id goes, and
+`message_cards` and `user_cards` fill in each card's id with a string
+replace rather than running a template per card.
+"""
+
+from flask import g, render_template
+from markupsafe import Markup
+
+from caching import TTLCache
+
+# Where to cut a fragment into parts; just an HTML comment if it leaks.
+SLOT = '<!--slot-->'
+
+# Stands in for the id in buttons rendered once for a whole page.
+ID = '__id__'
+
+# Versions catch changes; the TTL only bounds how long a fragment that
+# isn't looked at any more keeps its place.
+CACHE_SIZE = 20000
+CACHE_TTL = 3600
+
+cache = TTLCache(CACHE_SIZE, CACHE_TTL)
+
+
+def fragment(template, key, version, **context):
+    """Render `template` with `context`, or reuse the cached rendering for
+    `key` if it was made at this `version`.
+
+    Returns the markup cut at each {{ slot }} as a list of parts.
+    """
+
+    entry = cache.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    html = render_template(template, slot=Markup(SLOT), **context)
+    parts = [Markup(part) for part in html.split(SLOT)]
+    cache.set(key, (version, parts))
+    return parts
+
+
+def forget(key):
+    """Drop the cached fragment for `key`."""
+
+    cache.delete(key)
+
+
+def variants(template, state):
+    """Render the button `template` with `state` false and true, leaving
+    the {{ id }}s as markers to replace."""
+
+    return [render_template(template, id=Markup(ID), **{state: on})
+            for on in (False, True)]
+
+
+def message_cards(messages, liked_ids):
+    """The cards for `messages`, with like buttons for the current user."""
+
+    viewer_id = g.user.id if g.user else None
+    buttons = variants('messages/like_button.html', 'liked')
+
+    # (joined as plain strings: everything in them is already escaped)
+    cards = []
+    for msg in messages:
+        id = msg.id
+        parts = fragment('messages/card_body.html', ('message', id),
+                         (msg.timestamp, msg.user.version), msg=msg)
+        button = ('' if msg.user_id == viewer_id
+                  else buttons[id in liked_ids].replace(ID, str(id)))
+        cards.append(button.join(parts))
+    return Markup(''.join(cards))
+
+
+def user_cards(users, following_status):
+    """The cards for `users`, with follow buttons for the current user."""
+
+    viewer_id = g.user.id if g.user else None
+    buttons = variants('users/follow_button.html', 'following')
+
+    cards = []
+    for user in users:
+        id = user.id
+        parts = fragment('users/card_body.html', ('user', id),
+                         user.version, other_user=user)
+        button = ('' if id == viewer_id
+                  else buttons[bool(following_status.get(id))]
+                  .replace(ID, str(id)))
+        cards.append(button.join(parts))
+    return Markup(''.join(cards))
@@ -2,29 +2,56 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 20000000 \\
+        --follows 50000000 --shards 16 --seed 7
+
+Everything is generated offline and streamed straight to disk, so memory
+use doesn't grow with the size of the data set. The same arguments and
+seed always produce the same files.
+
+With --shards N > 1, N worker processes each write their own slice of the
+data to users-000.csv, messages-000.csv, follows-000.csv, etc. (seed.py
+loads any of these). Rows carry explicit ids so shards can be loaded in any
+order.
+
+Follows form a power-law graph: a few users follow a lot of people, and a
+few "celebrities" are followed by a large share of everyone.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+from faker.providers.lorem.en_US import Provider as LoremProvider
+
+from helpers import get_random_datetime, make_scatter, power_law_index, shard_ranges
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# bcrypt hash of "password", shared by every generated user
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# How lopsided popularity is (see helpers.power_law_index), and the most
+# people any one user follows.
+FOLLOWED_SKEW = 3
+POSTING_SKEW = 2
+MAX_FOLLOWING = 5000
 
-# Generate random profile image URLs to use for users
+WORDS = LoremProvider.word_list
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +59,136 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def csv_path(out_dir, name, shard, shards):
+    """users.csv for a single shard, users-003.csv for shard 3 of many."""
+
+    if shards == 1:
+        return os.path.join(out_dir, f"{name}.csv")
+    return os.path.join(out_dir, f"{name}-{shard:03}.csv")
+
+
+def write_users(path, first_id, last_id, rng, fake):
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
+        users_writer.writeheader()
+
+        for user_id in range(first_id, last_id + 1):
+            # suffix the id so usernames/emails stay unique at any size
+            username = f"{fake.user_name()}_{user_id}"
+            users_writer.writerow(dict(
+                id=user_id,
+                email=f"{username}@{fake.free_email_domain()}",
+                username=username,
+                image_url=rng.choice(image_urls),
+                password=PASSWORD,
+                bio=fake.sentence(),
+                header_image_url=rng.choice(header_image_urls),
+                location=fake.city()
+            ))
+
+
+def write_messages(path, first_id, last_id, num_users, rng, now, scatter):
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
+        messages_writer.writeheader()
+
+        for message_id in range(first_id, last_id + 1):
+            words = rng.choices(WORDS, k=rng.randint(3, 25))
+            messages_writer.writerow(dict(
+                id=message_id,
+                text=' '.join(words).capitalize()[:MAX_WARBLER_LENGTH],
+                timestamp=get_random_datetime(rng=rng, now=now),
+                user_id=scatter(power_law_index(rng, num_users, POSTING_SKEW))
+            ))
+
+
+def write_follows(path, first_id, last_id, num_users, per_user, rng, scatter):
+    max_following = min(MAX_FOLLOWING, num_users - 1)
+
+    with open(path, 'w', newline='') as follows_csv:
+        follows_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
+        follows_writer.writeheader()
+
+        for follower in range(first_id, last_id + 1):
+            # Pareto(2) has a mean of 2, so this averages out to per_user
+            wanted = min(max_following,
+                         int(per_user * rng.paretovariate(2) / 2))
+            followed = set()
+            tries = 0
+            while len(followed) < wanted and tries < wanted * 10:
+                tries += 1
+                user_id = scatter(power_law_index(rng, num_users, FOLLOWED_SKEW))
+                if user_id != follower:
+                    followed.add(user_id)
+
+            for user_id in sorted(followed):
+                follows_writer.writerow(dict(user_being_followed_id=user_id,
+                                             user_following_id=follower))
+
+
+def write_shard(args, shard):
+    """Write one shard's users, messages and follows CSVs."""
+
+    rng = Random(f"{args.seed}-{shard}")
+    fake = Faker()
+    fake.seed_instance(f"{args.seed}-{shard}")
+    scatter = make_scatter(args.users, args.seed)
+    now = datetime.fromtimestamp(args.now)
+
+    first, last = list(shard_ranges(args.users, args.shards))[shard]
+    write_users(csv_path(args.out, 'users', shard, args.shards),
+                first, last, rng, fake)
+
+    per_user = args.follows / args.users
+    write_follows(csv_path(args.out, 'follows', shard, args.shards),
+                  first, last, args.users, per_user, rng, scatter)
+
+    first, last = list(shard_ranges(args.messages, args.shards))[shard]
+    write_messages(csv_path(args.out, 'messages', shard, args.shards),
+                   first, last, args.users, rng, now, scatter)
+
+    return shard
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate CSVs of random data for Warbler.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS,
+                        help="roughly how many follows to generate")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="number of worker processes / files of each kind")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="random seed; same seed, same data")
+    parser.add_argument('--now', type=float,
+                        default=datetime(2021, 1, 1).timestamp(),
+                        help="POSIX time messages are dated back from")
+    parser.add_argument('--out', default='generator',
+                        help="directory to write the CSVs to")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+
+    if args.shards == 1:
+        write_shard(args, 0)
+        return
+
+    with Pool(args.shards) as pool:
+        for shard in pool.imap_unordered(
+                _write_shard, [(args, shard) for shard in range(args.shards)]):
+            print(f"shard {shard} done")
+
+
+def _write_shard(job):
+    return write_shard(*job)
+
+
+if __name__ == '__main__':
+    main()
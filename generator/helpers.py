@@ -1,14 +1,54 @@
 """Support functions for CSV generation."""
 
+import random
 from datetime import datetime
-from random import uniform
+from math import gcd
 
 
-def get_random_datetime(year_gap=2):
+def get_random_datetime(year_gap=2, rng=random, now=None):
     """Get a random datetime within the last few years."""
 
-    now = datetime.now()
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def power_law_index(rng, n, skew):
+    """A random index in [0, n), skewed towards 0.
+
+    With skew=1 every index is equally likely; the bigger the skew, the
+    more the low indexes dominate (a handful of "celebrities").
+    """
+
+    return min(int(n * rng.random() ** skew), n - 1)
+
+
+def make_scatter(n, seed):
+    """Make a function mapping 0 <= index < n to a unique id in [1, n].
+
+    The mapping is a pseudo-random bijection, so popular (low) indexes land
+    on random-looking user ids without keeping a shuffled list of all n
+    users in memory.
+    """
+
+    step = (seed * 2654435761 + 40503) % n or 1
+    while gcd(step, n) != 1:
+        step += 1
+
+    def scatter(index):
+        return (index * step + seed) % n + 1
+
+    return scatter
+
+
+def shard_ranges(total, shards):
+    """Split ids 1..total into `shards` contiguous (first, last) ranges."""
+
+    size, extra = divmod(total, shards)
+    first = 1
+    for shard in range(shards):
+        last = first + size - 1 + (1 if shard < extra else 0)
+        yield first, last
+        first = last + 1
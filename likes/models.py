@@ -1,4 +1,6 @@
-from db_setup import db
+from datetime import datetime
+
+from db_setup import db, insert_ignore
 
 
 class Like(db.Model):
@@ -6,18 +8,69 @@ class Like(db.Model):
 
     __tablename__ = 'likes'
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
+    __table_args__ = (
+        # the primary key answers "did I like this?" and lists a user's
+        # likes; this covers "who liked this?" and counting a message's
+        # likes, both without touching the table
+        db.Index('ix_likes_message_user', 'message_id', 'user_id'),
+        # a user's likes page, most recently liked first
+        db.Index('ix_likes_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    # When it was liked. (Likes from before this was recorded get their
+    # message's timestamp; see migrate.py.)
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default='1970-01-01 00:00:00',
     )
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Record that `user_id` likes `message_id`.
+
+        Returns False (and changes nothing) if they already did.
+        """
+
+        return insert_ignore(cls, user_id=user_id, message_id=message_id)
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Drop `user_id`'s like of `message_id`; False if there wasn't one."""
+
+        return bool(cls.query
+                    .filter(cls.user_id == user_id,
+                            cls.message_id == message_id)
+                    .delete(synchronize_session=False))
+
+    @classmethod
+    def liked_ids(cls, user, messages):
+        """Ids of the `messages` that `user` has liked.
+
+        Answers "did I like this?" for a whole page of message cards in one
+        query, so each card can do a set lookup.
+        """
+
+        if not user or not messages:
+            return set()
+
+        rows = (db.session
+                .query(cls.message_id)
+                .filter(cls.user_id == user.id,
+                        cls.message_id.in_([msg.id for msg in messages]))
+                .all())
+        return {row[0] for row in rows}
@@ -1,10 +1,45 @@
-from flask import Blueprint, redirect, render_template, g
+from flask import Blueprint, flash, redirect, render_template, g
 
 from messages.models import Message
+from users.models import User
+from users.current import forget_user
+from likes.models import Like
+from messages.trending import trending
 from db_setup import db
 
 like_views = Blueprint("like_routes", __name__)
 
+##############################################################################
+# Liking and unliking, shared with the JSON API:
+
+
+def like(message_id):
+    """Have the logged-in user like a message. Returns whether they
+    hadn't already."""
+
+    added = Like.add(g.user.id, message_id)
+    if added:
+        User.bump(g.user.id, likes_count=1)
+        Message.bump(message_id, likes_count=1)
+        db.session.commit()
+        forget_user(g.user.id)
+        trending.liked(message_id, g.user.id)
+    return added
+
+
+def unlike(message_id):
+    """Have the logged-in user unlike a message. Returns whether they
+    had liked it."""
+
+    removed = Like.remove(g.user.id, message_id)
+    if removed:
+        User.bump(g.user.id, likes_count=-1)
+        Message.bump(message_id, likes_count=-1)
+        db.session.commit()
+        forget_user(g.user.id)
+    return removed
+
+
 ##############################################################################
 # Like routes:
 
@@ -17,11 +52,7 @@ def like_message(msg_id):
         return redirect("/")
 
     msg = Message.query.get_or_404(msg_id)
-    #  if msg is already liked, unlike it
-    if msg in g.user.likes:
-        g.user.likes.remove(msg)
-    #  otherwise, like it
-    else:
-        g.user.likes.append(msg)
-    db.session.commit()
+    #  if msg is already liked, unlike it; otherwise, like it
+    if not unlike(msg.id):
+        like(msg.id)
     return redirect(f'/users/{g.user.id}/likes')
@@ -2,14 +2,28 @@ from db_setup import db
 from users.models import User
 from likes.models import Like
 
+import re
 from datetime import datetime
 
 
+WORD = re.compile(r"\w+")
+
+# a search query is made of "quoted phrases" and single words (maybe with
+# a trailing * for prefix matches)
+QUERY_PART = re.compile(r'"([^"]*)"|(\S+)')
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    __table_args__ = (
+        # a user's messages, newest first (profile pages, backfills and
+        # the celebrity side of the home feed)
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -23,7 +37,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -32,7 +46,230 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized like count, kept up to date by the like routes (see
+    # `bump`) and repaired by `recount`.
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
     def __repr__(self):
         return f"<Message #{self.id}: u_id={self.user_id}>"
+
+    @classmethod
+    def bump(cls, ids, **deltas):
+        """Adjust counter columns in place, e.g. bump(5, likes_count=1).
+
+        `ids` is a single message id or a query of message ids; see
+        `User.bump`.
+        """
+
+        if isinstance(ids, int):
+            messages = cls.query.filter(cls.id == ids)
+        else:
+            messages = cls.query.filter(cls.id.in_(ids))
+
+        messages.update({getattr(cls, column): getattr(cls, column) + delta
+                         for column, delta in deltas.items()},
+                        synchronize_session=False)
+
+    @classmethod
+    def recount(cls):
+        """Recompute every message's like count from scratch."""
+
+        likes = (db.session
+                 .query(db.func.count())
+                 .filter(Like.message_id == cls.id)
+                 .correlate(cls)
+                 .as_scalar())
+        cls.query.update({cls.likes_count: likes},
+                         synchronize_session=False)
+
+
+class TrendingMessage(db.Model):
+    """A message's trending score, as of the last snapshot.
+
+    Scores decay (halving every TRENDING_HALF_LIFE_HOURS), so they're
+    stored as `rank` = log2(score) + (half-lives since 1970): that doesn't
+    change as time passes, so ranks written at different times still compare,
+    and the index on it gives the top messages without any aggregating.
+    See messages.trending.
+    """
+
+    __tablename__ = 'trending_messages'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Float,
+        nullable=False,
+        index=True,
+    )
+
+
+class MessageTerm(db.Model):
+    """A posting in the message search index: `term` is word number
+    `position` of message `message_id`.
+
+    Searching looks terms up by the primary key, so it never has to scan
+    the text of every message. Terms are compared byte by byte (the "C"
+    collation on PostgreSQL; SQLite always does), so a prefix's terms are
+    one range of the key whatever the database's locale.
+    """
+
+    __tablename__ = 'message_terms'
+
+    term = db.Column(
+        db.Text().with_variant(db.Text(collation='C'), 'postgresql'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    position = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    @staticmethod
+    def tokenize(text):
+        """The lowercase words of `text`, in order."""
+
+        return WORD.findall((text or '').lower())
+
+    @classmethod
+    def rows_for(cls, message_id, text):
+        """The postings for one message."""
+
+        return [{'term': term, 'message_id': message_id, 'position': position}
+                for position, term in enumerate(cls.tokenize(text))]
+
+    @classmethod
+    def index(cls, message):
+        """Add `message` to the index (replacing any old postings)."""
+
+        cls.unindex(message)
+        rows = cls.rows_for(message.id, message.text)
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def unindex(cls, message):
+        """Take `message` out of the index."""
+
+        (cls.query
+         .filter(cls.message_id == message.id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        """Rebuild the whole index from the messages table."""
+
+        cls.query.delete(synchronize_session=False)
+
+        messages = (db.session
+                    .query(Message.id, Message.text)
+                    .order_by(Message.id))
+        rows = []
+        for message in messages.yield_per(batch_size):
+            rows.extend(cls.rows_for(*message))
+            if len(rows) >= batch_size:
+                db.session.execute(cls.__table__.insert(), rows)
+                rows = []
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+
+    @staticmethod
+    def _matching(term, word):
+        """Filter `term` postings for `word` ("war*" matches any prefix)."""
+
+        if word.endswith('*'):
+            prefix = word.rstrip('*')
+            # in byte order (see `term`), terms starting with the prefix
+            # sort before the prefix with its last character bumped
+            bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            return db.and_(term >= prefix, term < bound)
+        return term == word
+
+    @classmethod
+    def _containing(cls, words):
+        """Ids of messages with `words` next to each other, in order."""
+
+        postings = [db.aliased(cls) for word in words]
+        first = postings[0]
+        query = (db.session
+                 .query(first.message_id)
+                 .filter(cls._matching(first.term, words[0])))
+
+        for offset, (posting, word) in enumerate(zip(postings, words)):
+            if offset:
+                query = (query
+                         .join(posting, db.and_(
+                             posting.message_id == first.message_id,
+                             posting.position == first.position + offset))
+                         .filter(cls._matching(posting.term, word)))
+
+        return query
+
+    @classmethod
+    def search(cls, query, limit, position=None):
+        """Messages matching the search `query`, best match first.
+
+        Every word in the query must appear in the message. Words ending
+        in "*" match as prefixes, and "quoted phrases" must appear as
+        written. Messages that use the words more rank higher; ties go to
+        the newest.
+
+        Returns `limit` messages starting after the (rank, timestamp, id)
+        `position`, as a list of (rank, message) pairs.
+        """
+
+        clauses = []
+        for phrase, word in QUERY_PART.findall(query.lower()):
+            words = cls.tokenize(phrase) if phrase else cls.tokenize(word)
+            if word.endswith('*') and words:
+                words[-1] += '*'
+            if words:
+                clauses.append(words)
+
+        if not clauses:
+            return []
+
+        every_word = [word for words in clauses for word in words]
+        hits = (db.session
+                .query(cls.message_id,
+                       db.func.count().label('rank'))
+                .filter(db.or_(*[cls._matching(cls.term, word)
+                                  for word in every_word]))
+                .filter(*[cls.message_id.in_(cls._containing(words))
+                          for words in clauses])
+                .group_by(cls.message_id)
+                .subquery())
+
+        results = (db.session
+                   .query(hits.c.rank, Message)
+                   .join(Message, Message.id == hits.c.message_id))
+        if position:
+            results = results.filter(
+                db.tuple_(hits.c.rank, Message.timestamp, Message.id)
+                < db.tuple_(*position))
+
+        return (results
+                .order_by(hits.c.rank.desc(),
+                          Message.timestamp.desc(),
+                          Message.id.desc())
+                .limit(limit)
+                .all())
@@ -1,7 +1,16 @@
-from flask import Blueprint, flash, redirect, render_template, g
+from flask import Blueprint, flash, redirect, render_template, g, request
 from db_setup import db
-from messages.models import Message
+from messages.models import Message, MessageTerm
+from messages.trending import trending
+from users.models import User
 from messages.forms import MessageForm
+from likes.models import Like
+from timelines.models import TimelineEntry
+from users.current import forget_user
+from conditional import not_modified
+import fragments
+from pagination import (decode_ranked_cursor, encode_ranked_cursor,
+                        per_page)
 
 message_views = Blueprint("message_routes", __name__)
 
@@ -23,21 +32,74 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        TimelineEntry.fan_out(msg)
+        MessageTerm.index(msg)
+        User.bump(g.user.id, messages_count=1)
         db.session.commit()
+        forget_user(g.user.id)
+        trending.tick()
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@message_views.route('/messages/search')
+def messages_search():
+    """Search messages.
+
+    Takes a 'q' param of words, "quoted phrases" and prefix* words, and
+    an optional 'before' cursor for the next page of results.
+    """
+
+    search = request.args.get('q', '')
+    cursor = request.args.get('before')
+    position = decode_ranked_cursor(cursor) if cursor else None
+    limit = per_page()
+
+    results = MessageTerm.search(search, limit=limit + 1, position=position)
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        rank, last = results[-1]
+        next_cursor = encode_ranked_cursor(rank, last.timestamp, last.id)
+
+    messages = [msg for rank, msg in results]
+    return render_template('messages/search.html',
+                           search=search,
+                           messages=messages,
+                           liked_ids=Like.liked_ids(g.user, messages),
+                           next_cursor=next_cursor)
+
+
+@message_views.route('/messages/trending')
+def messages_trending():
+    """Show the messages with the most likes lately."""
+
+    messages = trending.top(per_page())
+    return render_template('messages/trending.html',
+                           messages=messages,
+                           liked_ids=Like.liked_ids(g.user, messages))
+
+
 @message_views.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = Message.query.get_or_404(message_id)
+    liked_ids = Like.liked_ids(g.user, [msg])
+    following = g.user and g.user.is_following(msg.user)
+
+    if not_modified(msg.id, msg.timestamp, msg.user.version,
+                    liked_ids, following):
+        return "", 304
+
+    return render_template('messages/show.html',
+                           message=msg,
+                           liked_ids=liked_ids)
 
 
 @message_views.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -50,8 +112,16 @@ def messages_destroy(message_id):
 
     msg = Message.query.get(message_id)
     if msg.user_id == g.user.id:
+        likers = (db.session
+                  .query(Like.user_id)
+                  .filter(Like.message_id == msg.id))
+        User.bump(likers, likes_count=-1)
+        User.bump(g.user.id, messages_count=-1)
+        MessageTerm.unindex(msg)
         db.session.delete(msg)
         db.session.commit()
+        forget_user(g.user.id)
+        fragments.forget(('message', message_id))
         return redirect(f"/users/{g.user.id}")
     else:
         flash("Delete Your Own Damn Messages!")
@@ -0,0 +1,260 @@
+"""Trending messages: the most liked lately, with older likes counting less.
+
+Each worker counts the likes it sees in a count-min sketch (a fixed-size
+table of counters, so it stays small however many messages get liked) and
+keeps the messages with the highest counts in a top-K heap. Every
+TRENDING_SNAPSHOT_SECONDS, those counts are added into the
+trending_messages table, which all workers share and the trending page
+reads. Nothing ever counts the likes table.
+
+A like is worth 1 when it happens and half that every half-life after.
+The table stores each message's score as a rank that doesn't decay (see
+TrendingMessage), so adding to a score is a single upsert, decayed in SQL,
+and reading the top messages is an index scan.
+
+Each worker only counts a user's like of a message once per window, so
+liking and unliking over and over doesn't push a message up.
+"""
+
+import heapq
+import logging
+import math
+from datetime import datetime, timedelta
+from threading import Lock
+from time import monotonic, time
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import selectinload
+
+from caching import TTLCache
+from db_setup import db
+from messages.models import Message, TrendingMessage
+
+log = logging.getLogger(__name__)
+
+# a score this far below 1 (in halvings) is as good as gone
+FORGET_AFTER_HALVINGS = 20
+
+# how many (user, message) likes each worker remembers, to count each once
+SEEN_LIKES = 50000
+
+
+class CountMinSketch:
+    """Approximate counts for any number of keys in `depth` x `width`
+    counters. Estimates can be too high (when keys share counters), never
+    too low."""
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for _ in range(depth)]
+
+    def _cells(self, key):
+        for row in range(self.depth):
+            yield row, hash((row, key)) % self.width
+
+    def add(self, key, count=1):
+        """Count `key` `count` more times; returns its new estimate."""
+
+        estimate = None
+        for row, cell in self._cells(key):
+            self.rows[row][cell] += count
+            value = self.rows[row][cell]
+            estimate = value if estimate is None else min(estimate, value)
+        return estimate
+
+    def estimate(self, key):
+        return min(self.rows[row][cell] for row, cell in self._cells(key))
+
+
+class TopK:
+    """The `k` keys with the highest scores seen so far.
+
+    Scores only go up. The heap may hold out-of-date entries for a key;
+    they're skipped (and the heap rebuilt when they pile up).
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.scores = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def _lowest(self):
+        while self._heap:
+            score, key = self._heap[0]
+            if self.scores.get(key) == score:
+                return score, key
+            heapq.heappop(self._heap)
+        return None
+
+    def offer(self, key, score):
+        """Consider `key` with `score`; keep it if it's in the top k."""
+
+        if key not in self.scores and len(self.scores) >= self.k:
+            lowest_score, lowest_key = self._lowest()
+            if score <= lowest_score:
+                return
+            heapq.heappop(self._heap)
+            del self.scores[lowest_key]
+
+        self.scores[key] = score
+        heapq.heappush(self._heap, (score, key))
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(score, key) for key, score in self.scores.items()]
+            heapq.heapify(self._heap)
+
+    def items(self):
+        return self.scores.items()
+
+
+class Trending:
+    """Likes seen by this worker since its last snapshot, and the trending
+    messages read back from the snapshots of all of them."""
+
+    def __init__(self, window_hours=24, half_life_hours=6,
+                 snapshot_seconds=60, candidates=200):
+        self.configure(window_hours, half_life_hours, snapshot_seconds,
+                       candidates)
+
+    def init_app(self, app):
+        """Set up from the app's config."""
+
+        self.configure(app.config.get('TRENDING_WINDOW_HOURS', 24),
+                       app.config.get('TRENDING_HALF_LIFE_HOURS', 6),
+                       app.config.get('TRENDING_SNAPSHOT_SECONDS', 60),
+                       app.config.get('TRENDING_CANDIDATES', 200))
+
+    def configure(self, window_hours, half_life_hours, snapshot_seconds,
+                  candidates):
+        self.window = timedelta(hours=window_hours)
+        self.half_life = half_life_hours * 3600
+        self.snapshot_seconds = snapshot_seconds
+        self.candidates = candidates
+        self._lock = Lock()
+        self._seen = TTLCache(SEEN_LIKES, window_hours * 3600)
+        self._reset()
+
+    def _reset(self):
+        self._sketch = CountMinSketch()
+        self._top = TopK(self.candidates)
+        self._last_snapshot = monotonic()
+
+    def _now(self):
+        """Current time in half-lives, the unit ranks are kept in."""
+
+        return time() / self.half_life
+
+    def liked(self, message_id, user_id):
+        """Count `user_id`'s like of `message_id`, unless it's been counted
+        already this window (snapshotting if one is due)."""
+
+        if self._seen.get((user_id, message_id)):
+            return
+        self._seen.set((user_id, message_id), True)
+
+        self._count({message_id: 1})
+        self.tick()
+
+    def _count(self, counts):
+        with self._lock:
+            for message_id, count in counts.items():
+                estimate = self._sketch.add(message_id, count)
+                self._top.offer(message_id, estimate)
+
+    def tick(self):
+        """Snapshot if it's been TRENDING_SNAPSHOT_SECONDS since the last."""
+
+        if monotonic() - self._last_snapshot >= self.snapshot_seconds:
+            self.snapshot()
+
+    def snapshot(self):
+        """Add the likes counted since the last snapshot to the table.
+
+        If that fails, the counts go back in to try again next time.
+        """
+
+        with self._lock:
+            counts = dict(self._top.items())
+            self._reset()
+
+        now = self._now()
+        try:
+            if counts:
+                self._add_scores(counts, now)
+            (TrendingMessage
+             .query
+             .filter(TrendingMessage.rank < now - FORGET_AFTER_HALVINGS)
+             .delete(synchronize_session=False))
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            self._count(counts)
+            log.warning("Trending snapshot failed; keeping its counts",
+                        exc_info=True)
+
+    @staticmethod
+    def _add_scores(counts, now):
+        """Add `counts` likes, worth 1 each `now`, to the messages' scores.
+
+        Each score is decayed to now and added to in SQL, in message id
+        order, so concurrent snapshots lock rows in the same order.
+        Messages that have been deleted are skipped.
+        """
+
+        table = TrendingMessage.__table__
+        count = db.bindparam('count')
+
+        def log2(value):
+            return db.func.ln(value) / math.log(2)
+
+        # (scores already forgotten count as 0, and keep exp() in range)
+        decayed = db.case(
+            [(table.c.rank > now - FORGET_AFTER_HALVINGS,
+              db.func.exp((table.c.rank - now) * math.log(2)))],
+            else_=0)
+        new_rows = (db.select([Message.id, log2(count) + now])
+                    .where(Message.id == db.bindparam('id')))
+        rows = [{'id': message_id, 'count': likes}
+                for message_id, likes in sorted(counts.items())]
+
+        dialect = db.session.get_bind(mapper=TrendingMessage.__mapper__,
+                                      clause=table.insert()).dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+            statement = (insert(table)
+                         .from_select(['message_id', 'rank'], new_rows)
+                         .on_conflict_do_update(
+                             index_elements=['message_id'],
+                             set_={'rank': log2(decayed + count) + now}))
+            db.session.execute(statement, rows)
+        else:
+            # (SQLite takes one writer at a time, so this doesn't race)
+            db.session.execute(
+                table.update()
+                .where(table.c.message_id == db.bindparam('id'))
+                .values(rank=log2(decayed + count) + now), rows)
+            db.session.execute(
+                table.insert()
+                .prefix_with('OR IGNORE')
+                .from_select(['message_id', 'rank'], new_rows), rows)
+
+    def top(self, limit):
+        """The `limit` top trending messages posted in the window."""
+
+        self.tick()
+        since = datetime.utcnow() - self.window
+        return (Message
+                .query
+                .options(selectinload(Message.user))
+                .join(TrendingMessage,
+                      TrendingMessage.message_id == Message.id)
+                .filter(Message.timestamp >= since)
+                .order_by(TrendingMessage.rank.desc(), Message.id.desc())
+                .limit(limit)
+                .all())
+
+
+trending = Trending()
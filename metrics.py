@@ -0,0 +1,280 @@
+"""Per-request instrumentation for Warbler.
+
+For every request, `Metrics` records how many SQL statements it ran, the
+time spent in them, the time spent rendering templates and the total
+time, in histograms labelled by endpoint. /metrics serves them in the
+Prometheus text format. A request that runs more than QUERY_BUDGET
+statements is logged, with the statement it repeated most (usually the
+sign of a lazy load in a loop).
+
+Statements are timed with SQLAlchemy engine events and templates with
+Flask's template signals. A histogram is a fixed list of bucket counters,
+so recording a request costs a few additions whatever the traffic.
+
+The numbers are this worker process's. Under gunicorn each worker keeps
+its own, and a scrape sees whichever worker answers it; that's enough to
+spot a slow or chatty endpoint, not to add up across workers.
+
+/metrics is only served with `Authorization: Bearer <METRICS_TOKEN>`, and
+not at all when METRICS_TOKEN isn't set.
+"""
+
+import hmac
+from bisect import bisect_left
+from collections import Counter
+from threading import Lock
+from time import perf_counter
+
+from flask import (Response, abort, current_app, g, has_request_context,
+                   before_render_template, request, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds of the histogram buckets (and +Inf after them)
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+def _format_labels(labels):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in labels)
+
+
+def _escape(value):
+    return (str(value)
+            .replace('\\', r'\\')
+            .replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+class Histogram:
+    """Counts of observed values in fixed buckets, with their sum, for each
+    set of label values."""
+
+    def __init__(self, name, help, label_names, buckets):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._lock = Lock()
+        # label values -> [bucket counts..., sum]
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        """Count `value` for the series with these `label_values`."""
+
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = (
+                    [0] * (len(self.buckets) + 2))
+            series[bucket] += 1
+            series[-1] += value
+
+    def count(self, *label_values):
+        """How many values have been observed for these `label_values`."""
+
+        with self._lock:
+            series = self._series.get(label_values)
+            return sum(series[:-1]) if series else 0
+
+    def total(self, *label_values):
+        """The sum of the values observed for these `label_values`."""
+
+        with self._lock:
+            series = self._series.get(label_values)
+            return series[-1] if series else 0
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def exposition(self):
+        """This histogram in the Prometheus text format, as lines."""
+
+        with self._lock:
+            series = {labels: list(counts)
+                      for labels, counts in self._series.items()}
+
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        bounds = [*(repr(float(b)) for b in self.buckets), '+Inf']
+        for label_values, counts in sorted(series.items()):
+            labels = list(zip(self.label_names, label_values))
+            total = 0
+            for bound, count in zip(bounds, counts):
+                total += count
+                bucket_labels = _format_labels([*labels, ('le', bound)])
+                yield f'{self.name}_bucket{{{bucket_labels}}} {total}'
+            labels = _format_labels(labels)
+            yield f'{self.name}_sum{{{labels}}} {counts[-1]!r}'
+            yield f'{self.name}_count{{{labels}}} {total}'
+
+
+def gauge(name, help, values):
+    """A gauge in the Prometheus text format, as lines. `values` maps
+    tuples of (label, value) pairs to the gauge's value for them."""
+
+    yield f'# HELP {name} {help}'
+    yield f'# TYPE {name} gauge'
+    for labels, value in sorted(values.items()):
+        yield f'{name}{{{_format_labels(labels)}}} {value!r}'
+
+
+class Metrics:
+    """Request histograms for an app, and the /metrics endpoint."""
+
+    def __init__(self):
+        self.duration = Histogram(
+            'warbler_request_duration_seconds',
+            'Time to handle a request.',
+            ('endpoint', 'method'), SECONDS_BUCKETS)
+        self.queries = Histogram(
+            'warbler_request_queries',
+            'SQL statements run per request.',
+            ('endpoint', 'method'), QUERY_BUCKETS)
+        self.db_time = Histogram(
+            'warbler_request_db_seconds',
+            'Time per request spent running SQL statements.',
+            ('endpoint', 'method'), SECONDS_BUCKETS)
+        self.template_time = Histogram(
+            'warbler_request_template_seconds',
+            'Time per request spent rendering templates.',
+            ('endpoint', 'method'), SECONDS_BUCKETS)
+        self.histograms = (self.duration, self.queries, self.db_time,
+                           self.template_time)
+        # functions returning more lines for /metrics
+        self.collectors = []
+
+    def init_app(self, app):
+        """Start timing `app`'s requests and add its /metrics endpoint.
+
+        Call this before registering other before_request functions, so
+        their time is counted too.
+        """
+
+        app.config.setdefault('QUERY_BUDGET', 20)
+        app.config.setdefault('METRICS_TOKEN', None)
+
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        before_render_template.connect(self._start_render, app)
+        template_rendered.connect(self._end_render, app)
+        app.add_url_rule('/metrics', 'metrics', self.exposition)
+
+        if not event.contains(Engine, 'before_cursor_execute',
+                              self._start_statement):
+            event.listen(Engine, 'before_cursor_execute',
+                         self._start_statement)
+            event.listen(Engine, 'after_cursor_execute', self._end_statement)
+
+    def register(self, collector):
+        """Have /metrics also serve the lines `collector()` returns (for
+        values read when scraped, like gauges)."""
+
+        self.collectors.append(collector)
+
+    def clear(self):
+        """Forget everything recorded so far."""
+
+        for histogram in self.histograms:
+            histogram.clear()
+
+    ##########################################################################
+    # Hooks
+
+    @staticmethod
+    def _start_request():
+        g.metrics_start = perf_counter()
+        g.metrics_queries = 0
+        g.metrics_db_time = 0.0
+        g.metrics_template_time = 0.0
+        g.metrics_statements = []
+        g.metrics_rendering = 0
+
+    def _end_request(self, response):
+        if 'metrics_start' not in g:
+            return response
+
+        elapsed = perf_counter() - g.metrics_start
+        labels = (request.endpoint or 'none', request.method)
+        self.duration.observe(elapsed, *labels)
+        self.queries.observe(g.metrics_queries, *labels)
+        self.db_time.observe(g.metrics_db_time, *labels)
+        self.template_time.observe(g.metrics_template_time, *labels)
+
+        budget = current_app.config['QUERY_BUDGET']
+        if budget is not None and g.metrics_queries > budget:
+            statement, repeats = (Counter(g.metrics_statements)
+                                  .most_common(1)[0])
+            current_app.logger.warning(
+                "%s %s (%s) ran %d SQL statements, over the budget of %d, "
+                "in %.0fms (%.0fms in SQL). Ran %d times: %s",
+                request.method, request.full_path.rstrip('?'),
+                request.endpoint, g.metrics_queries, budget,
+                elapsed * 1000, g.metrics_db_time * 1000,
+                repeats, ' '.join(statement.split()))
+
+        return response
+
+    # (the start time goes on the statement's execution context, which is
+    # thrown away with it if the statement fails)
+
+    @staticmethod
+    def _start_statement(conn, cursor, statement, parameters, context,
+                         executemany):
+        if context is not None:
+            context._metrics_started = perf_counter()
+
+    @staticmethod
+    def _end_statement(conn, cursor, statement, parameters, context,
+                       executemany):
+        started = getattr(context, '_metrics_started', None)
+        if (started is not None
+                and has_request_context() and 'metrics_start' in g):
+            g.metrics_queries += 1
+            g.metrics_db_time += perf_counter() - started
+            g.metrics_statements.append(statement)
+
+    @staticmethod
+    def _start_render(app, template, context):
+        if has_request_context() and 'metrics_start' in g:
+            # (templates rendered from inside another are timed with it)
+            if not g.metrics_rendering:
+                g.metrics_render_start = perf_counter()
+            g.metrics_rendering += 1
+
+    @staticmethod
+    def _end_render(app, template, context):
+        if has_request_context() and 'metrics_start' in g:
+            g.metrics_rendering -= 1
+            if not g.metrics_rendering:
+                g.metrics_template_time += (perf_counter()
+                                            - g.metrics_render_start)
+
+    ##########################################################################
+    # Endpoint
+
+    def exposition(self):
+        """Every histogram and collector, in the Prometheus text format."""
+
+        token = current_app.config['METRICS_TOKEN']
+        if not token:
+            abort(404)
+        given = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(given.encode(),
+                                   f'Bearer {token}'.encode()):
+            return Response('Unauthorized\n', 401,
+                            {'WWW-Authenticate': 'Bearer'})
+
+        lines = [line
+                 for histogram in self.histograms
+                 for line in histogram.exposition()]
+        for collector in self.collectors:
+            lines.extend(collector())
+        return Response('\n'.join(lines) + '\n',
+                        mimetype='text/plain; version=0.0.4')
+
+
+metrics = Metrics()
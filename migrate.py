@@ -0,0 +1,230 @@
+"""Bring an existing Warbler database up to date with the models.
+
+Run this after pulling new code, instead of dropping and re-seeding:
+
+    python migrate.py
+
+It only ever adds things (apart from reshaping the likes table once), so
+it's safe to run more than once:
+
+- tables that don't exist yet are created
+- columns missing from existing tables are added
+- a likes table from before likes were keyed on (user_id, message_id)
+  is rebuilt with that key, dropping duplicate likes
+- on PostgreSQL, columns declared with a collation (like the search
+  index's terms, compared in byte order) are given it
+- missing indexes are created (CONCURRENTLY on PostgreSQL, so the site
+  can stay up while they build)
+- derived data that lives in newly created tables or columns (counters,
+  timelines, search indexes) is filled in
+"""
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+from app import app, db
+from users.models import User, UserGram
+from messages.models import Message, MessageTerm
+from likes.models import Like
+from timelines.models import TimelineEntry
+
+
+def add_missing_tables(engine):
+    """Create any tables that don't exist yet; return their names."""
+
+    existing = set(inspect(engine).get_table_names())
+    db.metadata.create_all(bind=engine)
+    return set(db.metadata.tables) - existing
+
+
+def add_missing_columns(engine):
+    """Add columns missing from existing tables; return 'table.column's."""
+
+    inspector = inspect(engine)
+    added = set()
+
+    for table in db.metadata.sorted_tables:
+        existing = {col['name'] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            ddl = CreateColumn(column).compile(dialect=engine.dialect)
+            engine.execute(f'ALTER TABLE {table.name} ADD COLUMN {ddl}')
+            added.add(f'{table.name}.{column.name}')
+
+    return added
+
+
+def rekey_likes(engine):
+    """Key an old likes table (surrogate id, unique message_id) on
+    (user_id, message_id) instead; return whether it needed it."""
+
+    inspector = inspect(engine)
+    if 'id' not in {col['name'] for col in inspector.get_columns('likes')}:
+        return False
+
+    with engine.begin() as conn:
+        if engine.dialect.name == 'postgresql':
+            conn.execute("""
+                DELETE FROM likes
+                WHERE user_id IS NULL OR message_id IS NULL
+            """)
+            conn.execute("""
+                DELETE FROM likes AS dup
+                USING likes AS kept
+                WHERE dup.user_id = kept.user_id
+                  AND dup.message_id = kept.message_id
+                  AND dup.id > kept.id
+            """)
+            for unique in inspector.get_unique_constraints('likes'):
+                conn.execute(f'ALTER TABLE likes DROP CONSTRAINT {unique["name"]}')
+            # (takes the old primary key with it)
+            conn.execute('ALTER TABLE likes DROP COLUMN id')
+            conn.execute('ALTER TABLE likes ADD PRIMARY KEY (user_id, message_id)')
+        else:
+            # SQLite can't change a table's keys; copy it into a new one
+            for index in inspector.get_indexes('likes'):
+                conn.execute(f'DROP INDEX {index["name"]}')
+            conn.execute('ALTER TABLE likes RENAME TO likes_old')
+            Like.__table__.create(bind=conn)
+            conn.execute("""
+                INSERT INTO likes (user_id, message_id)
+                SELECT DISTINCT user_id, message_id
+                FROM likes_old
+                WHERE user_id IS NOT NULL AND message_id IS NOT NULL
+            """)
+            conn.execute('DROP TABLE likes_old')
+
+    return True
+
+
+def set_collations(engine):
+    """Give PostgreSQL columns the collation their model declares; return
+    the 'table.column's changed."""
+
+    if engine.dialect.name != 'postgresql':
+        return set()
+
+    changed = set()
+    for table in db.metadata.sorted_tables:
+        for column in table.columns:
+            collation = getattr(column.type.dialect_impl(engine.dialect),
+                                'collation', None)
+            if not collation:
+                continue
+
+            current = engine.execute("""
+                SELECT collation_name FROM information_schema.columns
+                WHERE table_name = %s AND column_name = %s
+            """, (table.name, column.name)).scalar()
+            if current == collation:
+                continue
+
+            # (rewrites the table and its indexes, in the new order)
+            type_ddl = column.type.compile(dialect=engine.dialect)
+            engine.execute(f'ALTER TABLE {table.name} '
+                           f'ALTER COLUMN {column.name} TYPE {type_ddl}')
+            changed.add(f'{table.name}.{column.name}')
+
+    return changed
+
+
+def add_missing_indexes(engine):
+    """Create indexes missing from existing tables; return their names."""
+
+    inspector = inspect(engine)
+    added = set()
+
+    with engine.connect() as conn:
+        if engine.dialect.name == 'postgresql':
+            # CREATE INDEX CONCURRENTLY can't run inside a transaction
+            conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+
+        for table in db.metadata.sorted_tables:
+            existing = {idx['name'] for idx in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+
+                index.dialect_kwargs['postgresql_concurrently'] = True
+                try:
+                    index.create(bind=conn)
+                finally:
+                    del index.dialect_kwargs['postgresql_concurrently']
+                added.add(index.name)
+
+    return added
+
+
+def fill_derived_data(tables, columns, likes_rekeyed=False):
+    """Fill in data that's derived from the rest of the database.
+
+    Rekeying likes drops duplicates, so like counts are redone after it.
+    """
+
+    if likes_rekeyed or {'users.messages_count', 'users.following_count',
+                         'users.followers_count',
+                         'users.likes_count'} & columns:
+        print('Counting messages, follows and likes...')
+        User.recount()
+    if likes_rekeyed or 'messages.likes_count' in columns:
+        print("Counting messages' likes...")
+        Message.recount()
+    if 'likes.timestamp' in columns:
+        # (when they were liked wasn't recorded; they can't be older
+        # than the message)
+        print('Dating likes...')
+        (Like
+         .query
+         .update({Like.timestamp: (db.session
+                                   .query(Message.timestamp)
+                                   .filter(Message.id == Like.message_id)
+                                   .as_scalar())},
+                 synchronize_session=False))
+    if 'timeline_entries' in tables:
+        print('Building home timelines...')
+        TimelineEntry.rebuild()
+    if 'user_grams' in tables:
+        print('Indexing users for search...')
+        UserGram.rebuild()
+    if 'message_terms' in tables:
+        print('Indexing messages for search...')
+        MessageTerm.rebuild()
+    db.session.commit()
+
+    if 'follow_suggestions' in tables:
+        # (a batch job, with dependencies of its own)
+        print('Run `flask suggest-follows --all` to suggest follows.')
+
+
+def migrate():
+    """Run every migration step, reporting what changed."""
+
+    engine = db.engine
+
+    tables = add_missing_tables(engine)
+    columns = add_missing_columns(engine)
+    likes_rekeyed = rekey_likes(engine)
+    collations = set_collations(engine)
+    indexes = add_missing_indexes(engine)
+
+    for kind, names in (('table', tables),
+                        ('column', columns),
+                        ('index', indexes)):
+        for name in sorted(names):
+            print(f'Added {kind} {name}')
+    for name in sorted(collations):
+        print(f'Set the collation of {name}')
+    if likes_rekeyed:
+        print('Rekeyed table likes on (user_id, message_id)')
+
+    fill_derived_data(tables, columns, likes_rekeyed)
+
+    if not (tables or columns or indexes or likes_rekeyed or collations):
+        print('Database is up to date.')
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        migrate()
@@ -0,0 +1,115 @@
+"""Keyset (cursor) pagination for Warbler's message lists.
+
+Lists are ordered newest-first on (timestamp, id). Instead of an OFFSET,
+each page remembers the position of its last message in an opaque cursor,
+and the next page starts strictly after it. Every page is therefore the
+same index range scan, no matter how far back the user has scrolled.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as DecodeError
+from datetime import datetime
+
+from flask import abort, current_app, request
+from sqlalchemy import tuple_
+
+
+def encode_cursor(timestamp, id):
+    """Turn a (timestamp, id) position into an opaque cursor string."""
+
+    return _pack(timestamp.isoformat(), id)
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into a (timestamp, id) position.
+
+    Aborts with a 400 if the cursor has been tampered with.
+    """
+
+    try:
+        timestamp, id = _unpack(cursor)
+        return datetime.fromisoformat(timestamp), int(id)
+    except ValueError:
+        abort(400)
+
+
+def encode_ranked_cursor(rank, timestamp, id):
+    """Cursor for lists ordered by a numeric rank before (timestamp, id)."""
+
+    return _pack(rank, timestamp.isoformat(), id)
+
+
+def decode_ranked_cursor(cursor):
+    """Turn a ranked cursor back into a (rank, timestamp, id) position."""
+
+    try:
+        rank, timestamp, id = _unpack(cursor)
+        return int(rank), datetime.fromisoformat(timestamp), int(id)
+    except ValueError:
+        abort(400)
+
+
+def _pack(*values):
+    raw = '|'.join(str(value) for value in values).encode('UTF-8')
+    return urlsafe_b64encode(raw).decode('UTF-8').rstrip('=')
+
+
+def _unpack(cursor):
+    try:
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        return raw.decode('UTF-8').split('|')
+    except (DecodeError, UnicodeDecodeError) as err:
+        raise ValueError(cursor) from err
+
+
+def current_position():
+    """Position of the page being requested (None for the first page)."""
+
+    cursor = request.args.get('before')
+    return decode_cursor(cursor) if cursor else None
+
+
+def per_page():
+    """How many messages to show on a page."""
+
+    return current_app.config['MESSAGES_PER_PAGE']
+
+
+def older_than(timestamp_col, id_col, position):
+    """Filter for rows that come after `position` in newest-first order."""
+
+    return tuple_(timestamp_col, id_col) < tuple_(*position)
+
+
+def paginate(query, timestamp_col, id_col, position=None, limit=None,
+             key=None):
+    """Fetch one page of `query`, ordered newest first.
+
+    Returns a (rows, next_cursor) pair; next_cursor is None on the last
+    page. Rows must have `timestamp` and `id` attributes, unless `key`
+    gives a row's (timestamp, id) position some other way.
+    """
+
+    limit = limit or per_page()
+
+    if position:
+        query = query.filter(older_than(timestamp_col, id_col, position))
+
+    rows = (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(limit + 1)
+            .all())
+    return split_page(rows, limit, key)
+
+
+def split_page(rows, limit, key=None):
+    """Split `limit` + 1 fetched rows into a page and the next cursor."""
+
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    if key:
+        return rows, encode_cursor(*key(rows[-1]))
+    last = rows[-1]
+    return rows, encode_cursor(last.timestamp, last.id)
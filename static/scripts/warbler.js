@@ -0,0 +1,49 @@
+// Like and follow buttons: send the change to the JSON API and update the
+// page in place, instead of posting the form and reloading.
+
+function updateStats(counts) {
+  for (let stat in counts) {
+    if (stat !== "id") {
+      $(`[data-user="${counts.id}"][data-stat="${stat}"]`).text(counts[stat]);
+    }
+  }
+}
+
+$(document).on("submit", ".like-form", function (evt) {
+  evt.preventDefault();
+  const $form = $(this);
+  const $button = $form.find("button");
+  const liked = $button.hasClass("btn-primary");
+
+  $.ajax({
+    url: `/api/v1/messages/${$form.data("message-id")}/like`,
+    method: liked ? "DELETE" : "PUT",
+  }).then(function (resp) {
+    $button.toggleClass("btn-primary", resp.data.liked)
+           .toggleClass("btn-secondary", !resp.data.liked);
+    updateStats(resp.data.user);
+  }).catch(() => this.submit());
+});
+
+$(document).on("submit", ".follow-form", function (evt) {
+  evt.preventDefault();
+  const $form = $(this);
+  const userId = $form.data("user-id");
+  const following = $form.attr("data-following") === "true";
+
+  $.ajax({
+    url: `/api/v1/users/${userId}/follow`,
+    method: following ? "DELETE" : "PUT",
+  }).then(function (resp) {
+    const now = resp.data.following;
+    $form.attr("data-following", String(now))
+         .attr("action", now ? `/users/stop-following/${userId}`
+                             : `/users/follow/${userId}`);
+    $form.find("button")
+         .text(now ? "Unfollow" : "Follow")
+         .toggleClass("btn-primary", now)
+         .toggleClass("btn-outline-primary", !now);
+    updateStats(resp.data.user);
+    updateStats(resp.data.followed);
+  }).catch(() => this.submit());
+});
@@ -5,3 +5,13 @@ from tests.test_message_model import *
 from tests.test_message_views import *
 from tests.test_user_views import *
 from tests.test_user_model import *
+from tests.test_timeline_model import *
+from tests.test_caching import *
+from tests.test_throttling import *
+from tests.test_api import *
+from tests.test_trending import *
+from tests.test_suggestions import *
+from tests.test_metrics import *
+from tests.test_query_counts import *
+from tests.test_db_setup import *
+from tests.test_replicas import *
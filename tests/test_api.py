@@ -0,0 +1,190 @@
+"""JSON API tests."""
+
+# run these tests like:
+# python -m unittest test_api.py
+
+import os
+from unittest import TestCase
+
+from db_setup import connect_db, db
+from users.models import User, Follow
+from messages.models import Message
+from likes.models import Like
+from timelines.models import TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import CURR_USER_KEY, app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class ApiTestCase(TestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        db.session.rollback()
+        Like.query.delete()
+        TimelineEntry.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User(email="test@test.com",
+                  username="testuser",
+                  password="HASHED_PASSWORD",
+                  following_count=1)
+        u2 = User(email="test2@test.com",
+                  username="testuser2",
+                  password="HASHED_PASSWORD",
+                  followers_count=1)
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        db.session.add(Follow(user_following_id=u1.id,
+                              user_being_followed_id=u2.id))
+        with app.app_context():
+            for i in range(3):
+                msg = Message(text=f"Message {i}", user_id=u2.id)
+                db.session.add(msg)
+                db.session.flush()
+                TimelineEntry.fan_out(msg)
+            db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['MESSAGES_PER_PAGE'] = 100
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def test_login_required(self):
+        """Are anonymous requests turned away with JSON?"""
+        with self.client as c:
+            resp = c.get("/api/v1/feed")
+            self.assertEqual(resp.status_code, 401)
+            self.assertEqual(resp.json, {"error": "Login required"})
+
+    def test_feed_pages(self):
+        """Does the feed come a page at a time, newest first?"""
+        app.config['MESSAGES_PER_PAGE'] = 2
+        with self.client as c:
+            self.login(c)
+
+            page = c.get("/api/v1/feed").json
+            self.assertEqual([m["text"] for m in page["data"]],
+                             ["Message 2", "Message 1"])
+            self.assertEqual(page["data"][0]["username"], "testuser2")
+
+            page = c.get(f"/api/v1/feed?before={page['next']}").json
+            self.assertEqual([m["text"] for m in page["data"]],
+                             ["Message 0"])
+            self.assertIsNone(page["next"])
+
+    def test_sparse_fields(self):
+        """Are only the requested fields sent?"""
+        with self.client as c:
+            self.login(c)
+
+            page = c.get(f"/api/v1/users/{self.u2_id}/messages"
+                         "?fields=text").json
+            self.assertEqual(page["data"][0], {"text": "Message 2"})
+
+            resp = c.get(f"/api/v1/users/{self.u2_id}?fields=username,bio")
+            self.assertEqual(resp.json["data"],
+                             {"username": "testuser2", "bio": None})
+
+            resp = c.get(f"/api/v1/users/{self.u2_id}?fields=password")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("password", resp.json["error"])
+
+    def test_follows(self):
+        """Do the following and followers lists match the follows?"""
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get(f"/api/v1/users/{self.u1_id}/following?fields=id")
+            self.assertEqual(resp.json["data"], [{"id": self.u2_id}])
+
+            resp = c.get(f"/api/v1/users/{self.u2_id}/followers?fields=id")
+            self.assertEqual(resp.json["data"], [{"id": self.u1_id}])
+
+            resp = c.get(f"/api/v1/users/{self.u2_id}/following")
+            self.assertEqual(resp.json, {"data": [], "next": None})
+
+    def test_missing(self):
+        """Is a missing message a JSON 404?"""
+        with self.client as c:
+            self.login(c)
+
+            resp = c.get("/api/v1/messages/0")
+            self.assertEqual(resp.status_code, 404)
+            self.assertIn("error", resp.json)
+
+    def test_like_is_idempotent(self):
+        """Can a message be liked and unliked any number of times?"""
+        m_id = Message.query.filter_by(text="Message 0").one().id
+        with self.client as c:
+            self.login(c)
+
+            for _ in range(2):
+                resp = c.put(f"/api/v1/messages/{m_id}/like")
+                self.assertEqual(resp.json["data"],
+                                 {"message_id": m_id,
+                                  "liked": True,
+                                  "likes_count": 1,
+                                  "user": {"id": self.u1_id,
+                                           "likes_count": 1}})
+            self.assertEqual(Like.query.count(), 1)
+
+            for _ in range(2):
+                resp = c.delete(f"/api/v1/messages/{m_id}/like")
+                self.assertFalse(resp.json["data"]["liked"])
+                self.assertEqual(resp.json["data"]["user"]["likes_count"], 0)
+            self.assertEqual(Like.query.count(), 0)
+
+            resp = c.put("/api/v1/messages/0/like")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_follow_is_idempotent(self):
+        """Can a user be followed and unfollowed any number of times?"""
+        with self.client as c:
+            self.login(c)
+
+            for _ in range(2):
+                resp = c.delete(f"/api/v1/users/{self.u2_id}/follow")
+                self.assertEqual(resp.json["data"],
+                                 {"following": False,
+                                  "user": {"id": self.u1_id,
+                                           "following_count": 0},
+                                  "followed": {"id": self.u2_id,
+                                               "followers_count": 0}})
+            self.assertEqual(TimelineEntry.query.count(), 3)
+
+            for _ in range(2):
+                resp = c.put(f"/api/v1/users/{self.u2_id}/follow")
+                self.assertTrue(resp.json["data"]["following"])
+                self.assertEqual(
+                    resp.json["data"]["followed"]["followers_count"], 1)
+            self.assertEqual(Follow.query.count(), 1)
+            self.assertEqual(TimelineEntry.query.count(), 6)
+
+            resp = c.put(f"/api/v1/users/{self.u1_id}/follow")
+            self.assertEqual(resp.status_code, 400)
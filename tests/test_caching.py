@@ -0,0 +1,45 @@
+"""Cache tests."""
+
+# run these tests like:
+# python -m unittest test_caching.py
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from caching import TTLCache
+
+
+class TTLCacheTestCase(TestCase):
+    """Test the in-process LRU/TTL cache."""
+
+    def test_get_and_set(self):
+        """Do values come back out until they're deleted?"""
+        cache = TTLCache(maxsize=2, ttl=30)
+        cache.set(1, "one")
+        self.assertEqual(cache.get(1), "one")
+        self.assertIsNone(cache.get(2))
+
+        cache.delete(1)
+        self.assertIsNone(cache.get(1))
+
+    def test_least_recently_used_is_evicted(self):
+        """When the cache is full, does the stalest key go first?"""
+        cache = TTLCache(maxsize=2, ttl=30)
+        cache.set(1, "one")
+        cache.set(2, "two")
+        cache.get(1)
+        cache.set(3, "three")
+
+        self.assertEqual(cache.get(1), "one")
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(len(cache), 2)
+
+    def test_entries_expire(self):
+        """Are entries dropped once their TTL is up?"""
+        cache = TTLCache(maxsize=2, ttl=30)
+        with patch('caching.monotonic', return_value=100):
+            cache.set(1, "one")
+        with patch('caching.monotonic', return_value=129):
+            self.assertEqual(cache.get(1), "one")
+        with patch('caching.monotonic', return_value=130):
+            self.assertIsNone(cache.get(1))
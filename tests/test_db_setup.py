@@ -0,0 +1,47 @@
+"""Database engine configuration tests."""
+
+# run these tests like:
+# python -m unittest test_db_setup.py
+
+from unittest import TestCase
+
+from sqlalchemy.pool import NullPool
+
+from db_setup import engine_options
+from metrics import gauge
+
+
+class EngineOptionsTestCase(TestCase):
+    """Test the PostgreSQL engine options built from the config."""
+
+    def test_pool(self):
+        """Is the pool sized and checked as configured?"""
+        options = engine_options({'DB_POOL_SIZE': 3,
+                                  'DB_MAX_OVERFLOW': 2,
+                                  'DB_POOL_RECYCLE': 600,
+                                  'DB_POOL_TIMEOUT': None,
+                                  'DB_POOL_PRE_PING': True})
+
+        self.assertEqual(options, {'pool_size': 3,
+                                   'max_overflow': 2,
+                                   'pool_recycle': 600,
+                                   'pool_pre_ping': True})
+
+    def test_pgbouncer(self):
+        """Does PgBouncer mode leave the pooling to PgBouncer?"""
+        options = engine_options({'DB_PGBOUNCER': True,
+                                  'DB_POOL_SIZE': 3,
+                                  'DB_POOL_PRE_PING': True})
+
+        self.assertEqual(options, {'poolclass': NullPool})
+
+    def test_gauge(self):
+        """Are pool stats served as Prometheus gauges?"""
+        lines = list(gauge('test_in_use', 'Test.',
+                           {(('bind', 'replica'),): 2,
+                            (('bind', 'default'),): 5}))
+
+        self.assertEqual(lines, ['# HELP test_in_use Test.',
+                                 '# TYPE test_in_use gauge',
+                                 'test_in_use{bind="default"} 5',
+                                 'test_in_use{bind="replica"} 2'])
@@ -8,7 +8,8 @@ from unittest import TestCase
 
 from db_setup import connect_db, db
 from users.models import User, Follow
-from messages.models import Message
+from messages.models import Message, MessageTerm
+from likes.models import Like
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -35,6 +36,7 @@ class MessageModelTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
         db.session.rollback()
+        Like.query.delete()
         User.query.delete()
         Message.query.delete()
         Follow.query.delete()
@@ -79,3 +81,66 @@ class MessageModelTestCase(TestCase):
         id = m.id
         self.assertEqual(
             m.__repr__(), f"<Message #{id}: u_id={self.u_id}>")
+
+    def test_many_users_like_a_message(self):
+        """Can a message be liked by more than one user, once each?"""
+        u2 = User(email="test2@test.com",
+                  username="testuser2",
+                  password="HASHED_PASSWORD")
+        m = Message(text="Test Message", user_id=self.u_id)
+        db.session.add_all([u2, m])
+        db.session.commit()
+
+        self.assertTrue(Like.add(self.u_id, m.id))
+        self.assertTrue(Like.add(u2.id, m.id))
+        self.assertFalse(Like.add(u2.id, m.id))
+        db.session.commit()
+
+        Message.recount()
+        db.session.commit()
+        db.session.refresh(m)
+        self.assertEqual(m.likes_count, 2)
+
+        self.assertTrue(Like.remove(u2.id, m.id))
+        self.assertFalse(Like.remove(u2.id, m.id))
+        self.assertEqual(Like.query.count(), 1)
+
+    def test_search(self):
+        """Does the search index find words, prefixes and phrases?"""
+        texts = ["Warblers warble in the spring",
+                 "the spring is here, spring spring spring",
+                 "Here is a warbler",
+                 "Jazz hands"]
+        messages = [Message(text=text, user_id=self.u_id) for text in texts]
+        db.session.add_all(messages)
+        db.session.flush()
+        for m in messages:
+            MessageTerm.index(m)
+        db.session.commit()
+        first, second, third, fourth = messages
+
+        def found(query, **kwargs):
+            return [m for rank, m in MessageTerm.search(query, 10, **kwargs)]
+
+        # all words must match; more uses rank higher
+        self.assertEqual(found("spring the"), [second, first])
+        self.assertEqual(found("warbl*"), [first, third])
+        self.assertEqual(found("warblers*"), [first])
+        self.assertEqual(found("warbles*"), [])
+        # (the bound for a prefix ending in z is "ja{", which sorts before
+        # "jaz" under most locales' collations, though not in byte order)
+        self.assertEqual(found("jaz*"), [fourth])
+        self.assertEqual(found("jazz*"), [fourth])
+        self.assertEqual(found('"is here"'), [second])
+        self.assertEqual(found('"here is" warbler'), [third])
+        self.assertEqual(found("winter"), [])
+        self.assertEqual(found(""), [])
+
+        # paging picks up after the last result
+        rank, m = MessageTerm.search("spring", 1)[0]
+        self.assertEqual(m, second)
+        self.assertEqual(
+            found("spring", position=(rank, m.timestamp, m.id)), [first])
+
+        MessageTerm.unindex(second)
+        self.assertEqual(found("spring"), [first])
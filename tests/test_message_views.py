@@ -11,6 +11,8 @@ from unittest import TestCase
 from db_setup import connect_db, db
 from users.models import User
 from messages.models import Message
+from likes.models import Like
+from timelines.models import TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -41,6 +43,8 @@ class MessageViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        Like.query.delete()
+        TimelineEntry.query.delete()
         User.query.delete()
         Message.query.delete()
 
@@ -200,3 +204,108 @@ class MessageViewTestCase(TestCase):
             # the message still exists
             test_m = Message.query.get(m.id)
             self.assertIsNotNone(test_m)
+
+    def test_liked_message_card(self):
+        """Does a liked message show as liked on the feed and its page?"""
+
+        other_user = User.signup(username="testuser2",
+                                 email="test2@test.com",
+                                 password="PASSWORD",
+                                 image_url=None)
+        db.session.commit()
+        other_id = other_user.id
+        m = Message(text="Like me", user_id=other_id)
+        unliked = Message(text="Not me", user_id=other_id)
+        db.session.add_all([m, unliked])
+        db.session.commit()
+        m_id = m.id
+        unliked_id = unliked.id
+        db.session.add(Like(user_id=self.testu_id, message_id=m_id))
+        db.session.commit()
+
+        def like_button(html, message_id):
+            return (html.split(f'data-message-id="{message_id}"')[1]
+                    .split('</form>')[0])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testu_id
+
+            html = c.get(f"/users/{other_id}").get_data(as_text=True)
+            self.assertIn("Like me", html)
+            self.assertIn("btn-primary", like_button(html, m_id))
+            self.assertIn("btn-secondary", like_button(html, unliked_id))
+            self.assertIn(f'action="/users/add_like/{unliked_id}"', html)
+
+            html = c.get(f"/messages/{m_id}").get_data(as_text=True)
+            self.assertIn("btn-primary", html)
+
+    def test_show_message_not_modified(self):
+        """Is an unchanged message page answered with a 304?"""
+
+        other_user = User.signup(username="testuser2",
+                                 email="test2@test.com",
+                                 password="PASSWORD",
+                                 image_url=None)
+        db.session.commit()
+        m = Message(text="Like me", user_id=other_user.id)
+        db.session.add(m)
+        db.session.commit()
+        m_id = m.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testu_id
+
+            resp = c.get(f"/messages/{m_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("private", resp.headers["Cache-Control"])
+            etag = resp.headers["ETag"]
+            self.assertTrue(etag.startswith('W/'))
+
+            resp = c.get(f"/messages/{m_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            # liking it changes the page
+            c.post(f"/users/add_like/{m_id}")
+            resp = c.get(f"/messages/{m_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers["ETag"], etag)
+
+    def test_static_files_are_fingerprinted(self):
+        """Are static URLs versioned and cached for a long time?"""
+
+        with self.client as c:
+            html = c.get("/login").get_data(as_text=True)
+            self.assertIn("/static/stylesheets/style.css?v=", html)
+
+            resp = c.get("/static/stylesheets/style.css?v=1")
+            self.assertEqual(resp.headers["Cache-Control"],
+                             "public, max-age=31536000, immutable")
+            resp.close()
+
+            # unversioned URLs may change, so aren't marked immutable
+            resp = c.get("/static/stylesheets/style.css")
+            self.assertNotIn("immutable",
+                             resp.headers.get("Cache-Control", ""))
+            resp.close()
+
+    def test_search_messages(self):
+        """Can anyone search for warbles?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testu_id
+
+            c.post("/messages/new", data={"text": "Hello search"})
+            c.post("/messages/new", data={"text": "Goodbye"})
+
+            html = c.get("/messages/search?q=hel*").get_data(as_text=True)
+            self.assertIn("Hello search", html)
+            self.assertNotIn("Goodbye", html)
+
+            html = c.get("/messages/search?q=nothing").get_data(as_text=True)
+            self.assertIn("Sorry, no warbles found", html)
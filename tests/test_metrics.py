@@ -0,0 +1,126 @@
+"""Request instrumentation tests."""
+
+# run these tests like:
+# python -m unittest test_metrics.py
+
+import os
+from unittest import TestCase
+
+from db_setup import connect_db, db
+from metrics import Histogram, metrics
+from users.models import User
+from messages.models import Message
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import CURR_USER_KEY, app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class HistogramTestCase(TestCase):
+    """Test the histogram and its text format."""
+
+    def test_exposition(self):
+        """Are buckets cumulative, with a sum and count per series?"""
+        histogram = Histogram('test_seconds', 'Test.', ('endpoint',),
+                              (0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, 'home')
+        histogram.observe(0.5, 'say "hi"')
+
+        lines = list(histogram.exposition())
+        self.assertEqual(lines[:7], [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{endpoint="home",le="0.1"} 2',
+            'test_seconds_bucket{endpoint="home",le="1.0"} 3',
+            'test_seconds_bucket{endpoint="home",le="+Inf"} 4',
+            'test_seconds_sum{endpoint="home"} 2.65',
+            'test_seconds_count{endpoint="home"} 4',
+        ])
+        self.assertIn('test_seconds_count{endpoint="say \\"hi\\""} 1', lines)
+        self.assertEqual(histogram.count('home'), 4)
+
+
+class MetricsViewTestCase(TestCase):
+    """Test what's recorded per request, and /metrics."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        Message.query.delete()
+        User.query.delete()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+        metrics.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['QUERY_BUDGET'] = 20
+        app.config['METRICS_TOKEN'] = None
+
+    def test_request_recorded(self):
+        """Are a request's statements and time recorded by endpoint?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/users/{self.testuser_id}")
+            self.assertEqual(resp.status_code, 200)
+
+        labels = ('user_routes.users_show', 'GET')
+        self.assertEqual(metrics.duration.count(*labels), 1)
+        self.assertEqual(metrics.template_time.count(*labels), 1)
+
+        app.config['METRICS_TOKEN'] = "secret"
+        resp = self.client.get("/metrics",
+                               headers={"Authorization": "Bearer secret"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        text = resp.get_data(as_text=True)
+        self.assertIn('# TYPE warbler_request_queries histogram', text)
+        self.assertIn('warbler_request_queries_count'
+                      '{endpoint="user_routes.users_show",method="GET"} 1',
+                      text)
+        # some statements were run, so not all were in the 0 bucket
+        self.assertNotIn('warbler_request_queries_bucket'
+                         '{endpoint="user_routes.users_show",method="GET",'
+                         'le="0.0"} 1', text)
+
+    def test_query_budget(self):
+        """Are requests over the query budget logged?"""
+        app.config['QUERY_BUDGET'] = 0
+
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            self.client.get(f"/users/{self.testuser_id}")
+
+        self.assertIn("over the budget of 0", logs.output[0])
+        self.assertIn("user_routes.users_show", logs.output[0])
+
+    def test_metrics_needs_token(self):
+        """Is /metrics hidden without a token, and refused with a wrong one?"""
+        self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+        app.config['METRICS_TOKEN'] = "secret"
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        resp = self.client.get("/metrics",
+                               headers={"Authorization": "Bearer wrong"})
+        self.assertEqual(resp.status_code, 401)
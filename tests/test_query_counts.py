@@ -0,0 +1,211 @@
+"""Query count tests: how many SQL statements each page runs.
+
+Each page is rendered for a small and a large dataset, and must run the
+same number of statements for both, within a fixed budget. A lazy load
+in a template loop (an N+1) grows with the data and fails here.
+"""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_query_counts.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from db_setup import connect_db, db
+from users.models import User, Follow
+from users.current import snapshots
+from messages.models import Message, TrendingMessage
+from messages.trending import trending
+from likes.models import Like
+from timelines.models import TimelineEntry
+import fragments
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import CURR_USER_KEY, app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class QueryCounter:
+    """Counts the SQL statements run while it's active:
+
+        with QueryCounter() as queries:
+            ...
+        queries.count
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def _count(self, conn, cursor, statement, parameters, context,
+               executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self._count)
+
+
+class QueryCountTestCase(TestCase):
+    """Test that pages run a fixed number of statements, whatever the data."""
+
+    # (authors, messages) for the small and the large dataset
+    SMALL = (2, 4)
+    LARGE = (50, 100)
+
+    def setUp(self):
+        """Create test client and the user pages are viewed as."""
+
+        db.session.rollback()
+        TrendingMessage.query.delete()
+        TimelineEntry.query.delete()
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.viewer = User(username="viewer", email="viewer@test.com",
+                           password="HASHED_PASSWORD")
+        db.session.add(self.viewer)
+        db.session.commit()
+        self.viewer_id = self.viewer.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer_id
+
+    def tearDown(self):
+        # (ids are reused, so leave nothing behind for other tests)
+        db.session.rollback()
+        TrendingMessage.query.delete()
+        TimelineEntry.query.delete()
+        Like.query.delete()
+        Follow.query.delete()
+        db.session.commit()
+
+    def populate(self, authors, messages):
+        """`authors` users who follow and are followed by the viewer, and
+        `messages` messages spread between them, all liked by the viewer.
+        Returns a message id and an author id."""
+
+        now = datetime.utcnow()
+        users = [User(username=f"author{i}-{authors}",
+                      email=f"author{i}-{authors}@test.com",
+                      password="HASHED_PASSWORD")
+                 for i in range(authors)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        msgs = [Message(text=f"message {i}",
+                        timestamp=now - timedelta(minutes=i),
+                        user_id=users[i % authors].id)
+                for i in range(messages)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        for user in users:
+            db.session.add(Follow(user_following_id=self.viewer_id,
+                                  user_being_followed_id=user.id))
+            db.session.add(Follow(user_following_id=user.id,
+                                  user_being_followed_id=self.viewer_id))
+        for msg in msgs:
+            db.session.add(Like(user_id=self.viewer_id, message_id=msg.id))
+            db.session.add(TrendingMessage(message_id=msg.id, rank=msg.id))
+        db.session.commit()
+        ids = msgs[0].id, users[0].id
+
+        with app.app_context():
+            User.recount()
+            Message.recount()
+            TimelineEntry.rebuild()
+            db.session.commit()
+
+        return ids
+
+    def queries(self, path):
+        """How many statements GETting `path` runs, with cold caches."""
+
+        snapshots.clear()
+        fragments.cache.clear()
+        db.session.expire_all()
+        # so a trending snapshot isn't due in the middle of the request
+        trending.snapshot()
+
+        with QueryCounter() as queries:
+            resp = self.client.get(path)
+        self.assertEqual(resp.status_code, 200, path)
+        return queries.count
+
+    def assertQueries(self, limit, path):
+        """Does `path` run at most `limit` statements, for small and large
+        datasets alike?"""
+
+        counts = []
+        for size in (self.SMALL, self.LARGE):
+            message_id, author_id = self.populate(*size)
+            counts.append(self.queries(path.format(
+                viewer=self.viewer_id, message=message_id,
+                author=author_id)))
+
+        small, large = counts
+        self.assertEqual(large, small, f"{path} runs more statements "
+                         "with more data")
+        self.assertLessEqual(large, limit, path)
+
+    def test_homepage(self):
+        """The home feed, 100 messages from 50 authors."""
+        # Six, one for each thing the page shows: the user (cold cache),
+        # their timeline, its authors, the celebrities they follow (merged
+        # in at read time, see timelines), who to follow and which of the
+        # messages they've liked. None of them grows with the feed; what
+        # this pins is that the count stays at six for any amount of data,
+        # not "under 6" -- getting to five would mean folding the liked
+        # ids into the timeline query.
+        self.assertQueries(6, "/")
+
+    def test_users_show(self):
+        self.assertQueries(5, "/users/{author}")
+
+    def test_show_following(self):
+        self.assertQueries(4, "/users/{viewer}/following")
+
+    def test_users_followers(self):
+        self.assertQueries(4, "/users/{viewer}/followers")
+
+    def test_show_likes(self):
+        self.assertQueries(5, "/users/{viewer}/likes")
+
+    def test_list_users(self):
+        self.assertQueries(4, "/users")
+
+    def test_messages_show(self):
+        self.assertQueries(5, "/messages/{message}")
+
+    def test_trending(self):
+        self.assertQueries(2, "/messages/trending")
+
+    def test_api_feed(self):
+        self.assertQueries(3, "/api/v1/feed")
@@ -0,0 +1,221 @@
+"""Read replica routing tests.
+
+A second SQLite database stands in for a replica. It has the same
+schema, but its copy of a user has a different username, so pages show
+which database they read from.
+"""
+
+# run these tests like:
+# python -m unittest test_replicas.py
+
+import os
+import tempfile
+from threading import Event
+from time import monotonic, time
+from unittest import TestCase
+from unittest.mock import patch
+
+from db_setup import ReplicaSelector, connect_db, db
+from users.models import User, Follow
+from users.current import snapshots
+from messages.models import Message
+from timelines.models import TimelineEntry
+import fragments
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import CURR_USER_KEY, app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+_, REPLICA_PATH = tempfile.mkstemp(suffix='.db')
+
+
+class ReplicaSelectorTestCase(TestCase):
+    """Test choosing a replica."""
+
+    def test_round_robin(self):
+        """Do replicas take turns?"""
+        replicas = ReplicaSelector(['a', 'b'])
+
+        self.assertEqual([replicas.acquire() for _ in range(3)],
+                         ['a', 'b', 'a'])
+
+    def test_least_loaded(self):
+        """Is the replica with the fewest requests on it picked?"""
+        replicas = ReplicaSelector(['a', 'b'], 'least-loaded')
+
+        self.assertEqual(replicas.acquire(), 'a')
+        self.assertEqual(replicas.acquire(), 'b')
+        replicas.release('b')
+        # (round-robin would pick 'a')
+        self.assertEqual(replicas.acquire(), 'b')
+
+    def test_least_loaded_probe(self):
+        """Does the probed load (from every worker) steer the choice, and
+        is it only re-read every probe_seconds?"""
+        loads = {'a': 5, 'b': 1}
+        probed = []
+
+        def probe(name):
+            probed.append(name)
+            return loads[name]
+
+        replicas = ReplicaSelector(['a', 'b'], 'least-loaded', probe, 60)
+        # (the first probe runs in the background; nothing's known yet)
+        self.assertEqual(replicas.acquire(), 'a')
+        replicas.release('a')
+        replicas._prober.join()
+
+        self.assertEqual(replicas.acquire(), 'b')
+        loads['b'] = 10
+        # not re-probed yet; b has 1 + 1 in use, still less than 5
+        self.assertEqual(replicas.acquire(), 'b')
+        self.assertEqual(probed, ['a', 'b'])
+
+    def test_slow_probe_doesnt_block(self):
+        """Are requests served while a probe hangs?"""
+        stuck = Event()
+
+        def probe(name):
+            stuck.wait(5)
+            return 0
+
+        replicas = ReplicaSelector(['a', 'b'], 'least-loaded', probe, 0)
+        try:
+            started = monotonic()
+            for _ in range(4):
+                replicas.release(replicas.acquire())
+            self.assertLess(monotonic() - started, 1)
+        finally:
+            stuck.set()
+            replicas._prober.join()
+
+    def test_failing_probe_backs_off(self):
+        """Is a replica whose probe fails avoided, and not re-probed every
+        time?"""
+        probed = []
+
+        def probe(name):
+            probed.append(name)
+            if name == 'a':
+                raise OSError("timeout expired")
+            return 3
+
+        replicas = ReplicaSelector(['a', 'b'], 'least-loaded', probe, 0)
+        replicas.release(replicas.acquire())
+        replicas._prober.join()
+
+        for _ in range(2):
+            self.assertEqual(replicas.acquire(), 'b')
+            replicas._prober.join()
+        # b was probed again each time; a waits out its backoff
+        self.assertEqual(probed, ['a', 'b', 'b', 'b'])
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test which database requests read from and write to."""
+
+    def setUp(self):
+        """Create a primary and a replica with different data."""
+
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica': f'sqlite:///{REPLICA_PATH}'}
+        app.config['DB_REPLICAS'] = ['replica']
+        db.configure_replicas(app)
+        self.replica = db.get_engine(app, 'replica')
+        db.metadata.drop_all(bind=self.replica)
+        db.metadata.create_all(bind=self.replica)
+
+        TimelineEntry.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        u1 = User(username="testuser", email="test@test.com",
+                  password="HASHED_PASSWORD")
+        u2 = User(username="testuser2", email="test2@test.com",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        # the replica's copy of u2 is out of date
+        for user, username in ((u1, "testuser"), (u2, "old-name")):
+            self.replica.execute(User.__table__.insert().values(
+                id=user.id, username=username, email=user.email,
+                password=user.password))
+        db.session.remove()
+
+        snapshots.clear()
+        fragments.cache.clear()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        db.session.remove()
+        app.config['SQLALCHEMY_BINDS'] = {}
+        app.config['DB_REPLICAS'] = []
+        db.configure_replicas(app)
+        TimelineEntry.query.delete()
+        Follow.query.delete()
+        db.session.commit()
+
+    def profile_name(self):
+        fragments.cache.clear()
+        html = self.client.get(f"/users/{self.u2_id}").get_data(as_text=True)
+        if "@old-name" in html:
+            return "replica"
+        if "@testuser2" in html:
+            return "primary"
+
+    def test_reads_from_replica(self):
+        """Do GET requests read from the replica?"""
+        self.assertEqual(self.profile_name(), "replica")
+
+    def test_reads_own_writes(self):
+        """After a write, do reads stay on the primary for a while?"""
+        resp = self.client.post(f"/users/follow/{self.u2_id}")
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Follow.query.count(), 1)
+
+        self.assertEqual(self.profile_name(), "primary")
+
+        later = time() + app.config['DB_REPLICA_STICKY_SECONDS'] + 1
+        with patch('db_setup.time', return_value=later):
+            self.assertEqual(self.profile_name(), "replica")
+
+    def test_writes_go_to_primary(self):
+        """Do writes in a GET request go to the primary, and the reads
+        after them too?"""
+        with app.test_request_context("/"):
+            app.preprocess_request()
+
+            self.assertEqual(User.query.get(self.u2_id).username,
+                             "old-name")
+
+            db.session.add(Message(text="hi", user_id=self.u1_id))
+            db.session.commit()
+            self.assertEqual(User.query.get(self.u2_id).username,
+                             "testuser2")
+
+            db.session.remove()
+
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(
+            self.replica.execute("SELECT count(*) FROM messages").scalar(),
+            0)
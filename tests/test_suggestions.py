@@ -0,0 +1,121 @@
+"""Follow suggestion tests."""
+
+# run these tests like:
+# python -m unittest test_suggestions.py
+
+import os
+from unittest import TestCase
+
+from db_setup import connect_db, db
+from users.models import User, Follow, FollowSuggestion, StaleSuggestions
+from users.suggestions import suggest_follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import CURR_USER_KEY, app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class SuggestionsTestCase(TestCase):
+    """Test the "who to follow" batch job and where it's shown."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        db.session.rollback()
+        FollowSuggestion.query.delete()
+        StaleSuggestions.query.delete()
+        Follow.query.delete()
+        User.query.delete()
+
+        users = [User(email=f"test{i}@test.com",
+                      username=f"testuser{i}",
+                      password="HASHED_PASSWORD")
+                 for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.ids = u0, u1, u2, u3, u4 = [u.id for u in users]
+
+        # u0 follows u1, who follows u2 and u3; u4 follows u0 and u3
+        for follower, followed in ((u0, u1), (u1, u2), (u1, u3),
+                                   (u4, u0), (u4, u3)):
+            db.session.add(Follow(user_following_id=follower,
+                                  user_being_followed_id=followed))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        FollowSuggestion.query.delete()
+        StaleSuggestions.query.delete()
+        db.session.commit()
+
+    def suggestions(self, user_id):
+        return {s.suggested_id: s.score
+                for s in FollowSuggestion.query.filter_by(user_id=user_id)}
+
+    def test_scores(self):
+        """Are friends of friends and common followers scored?"""
+        u0, u1, u2, u3, u4 = self.ids
+        suggest_follows(everyone=True, workers=1)
+
+        # u3: followed by u1 (whom u0 follows) and by u4 (who follows u0)
+        self.assertEqual(self.suggestions(u0), {u2: 1.0, u3: 1.5})
+        # never someone they already follow, or themselves
+        self.assertNotIn(u3, self.suggestions(u4))
+        self.assertNotIn(u4, self.suggestions(u4))
+
+        self.assertEqual([u.id for u in FollowSuggestion.for_user(u0, 5)],
+                         [u3, u2])
+
+    def test_everyone_replaces_suggestions(self):
+        """Does a full run replace suggestions, clearing them for users
+        who no longer follow or are followed by anyone?"""
+        u0, u1, u2, u3, u4 = self.ids
+        suggest_follows(everyone=True, workers=1)
+
+        Follow.query.filter(db.or_(Follow.user_following_id == u4,
+                                   Follow.user_being_followed_id == u4)
+                            ).delete(synchronize_session=False)
+        db.session.commit()
+        self.assertNotEqual(self.suggestions(u4), {})
+
+        suggest_follows(everyone=True, workers=1)
+        self.assertEqual(self.suggestions(u4), {})
+        # (without u4, u3 is only a friend of a friend)
+        self.assertEqual(self.suggestions(u0), {u2: 1.0, u3: 1.0})
+
+    def test_incremental(self):
+        """Does a follow only redo the suggestions that depend on it?"""
+        u0, u1, u2, u3, u4 = self.ids
+        suggest_follows(everyone=True, workers=1)
+        self.assertEqual(suggest_follows(workers=1), 0)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u0
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("Who to follow", html)
+            self.assertIn("@testuser3", html)
+
+            c.post(f"/users/follow/{u3}")
+            # already hidden, before the job runs again
+            self.assertNotIn(u3, [u.id for u in
+                                  FollowSuggestion.for_user(u0, 5)])
+
+        self.assertGreater(suggest_follows(workers=1), 0)
+        self.assertEqual(self.suggestions(u0), {u2: 1.0})
+        self.assertEqual(StaleSuggestions.query.count(), 0)
@@ -0,0 +1,65 @@
+"""Rate limiter tests."""
+
+# run these tests like:
+# python -m unittest test_throttling.py
+
+from unittest import TestCase
+
+from throttling import MemoryBackend, SlidingWindowLimiter
+
+
+class DictBackend:
+    """Stand-in for a shared store like Redis: plain counters, no expiry."""
+
+    def __init__(self):
+        self.counts = {}
+
+    def get(self, key):
+        return self.counts.get(key, 0)
+
+    def incr(self, key, ttl):
+        self.counts[key] = self.counts.get(key, 0) + 1
+        return self.counts[key]
+
+
+class SlidingWindowLimiterTestCase(TestCase):
+    """Test the sliding window rate limiter."""
+
+    def test_limit_per_key(self):
+        """Are hits past the limit refused, for that key only?"""
+        limiter = SlidingWindowLimiter(MemoryBackend(), 'test', 3, 60)
+
+        self.assertEqual([limiter.hit('a', now=0) for _ in range(4)],
+                         [True, True, True, False])
+        self.assertTrue(limiter.hit('b', now=0))
+
+    def test_window_slides(self):
+        """Do earlier hits count less as they slide out of the window?"""
+        limiter = SlidingWindowLimiter(MemoryBackend(), 'test', 4, 60)
+        for _ in range(4):
+            limiter.hit('a', now=50)
+
+        # 3/4 of the previous window still overlaps: 4 * 0.75 = 3 hits
+        self.assertTrue(limiter.hit('a', now=75))
+        self.assertFalse(limiter.hit('a', now=75))
+        # a window later, nothing from 50 is left
+        self.assertTrue(limiter.hit('a', now=120))
+
+    def test_shared_backend(self):
+        """Do limiters sharing a backend share their counts?"""
+        backend = DictBackend()
+        first = SlidingWindowLimiter(backend, 'test', 2, 60)
+        second = SlidingWindowLimiter(backend, 'test', 2, 60)
+
+        self.assertTrue(first.hit('a', now=0))
+        self.assertTrue(second.hit('a', now=0))
+        self.assertFalse(first.hit('a', now=0))
+
+    def test_memory_backend_is_bounded(self):
+        """Does the in-process backend evict the least recently used keys?"""
+        backend = MemoryBackend(maxsize=2)
+        for key in ('a', 'b', 'c'):
+            backend.incr(key, ttl=60)
+
+        self.assertEqual(backend.get('a'), 0)
+        self.assertEqual(backend.get('c'), 1)
@@ -0,0 +1,118 @@
+"""Timeline model tests."""
+
+# run these tests like:
+# python -m unittest test_timeline_model.py
+
+import os
+from unittest import TestCase
+
+from db_setup import connect_db, db
+from users.models import User, Follow
+from messages.models import Message
+from timelines.models import TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import CURR_USER_KEY, app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineModelTestCase(TestCase):
+    """Test the fanned-out home timeline."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        db.session.rollback()
+        TimelineEntry.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User(email="test@test.com",
+                  username="testuser",
+                  password="HASHED_PASSWORD")
+        u2 = User(email="test2@test.com",
+                  username="testuser2",
+                  password="HASHED_PASSWORD")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_new_message_fans_out_to_followers(self):
+        """Does posting a message put it on followers' timelines?"""
+        with self.client as c:
+            self.login(c, self.u1_id)
+            c.post(f"/users/follow/{self.u2_id}")
+
+            self.login(c, self.u2_id)
+            c.post("/messages/new", data={"text": "Hello followers"})
+
+            msg = Message.query.one()
+            readers = {e.user_id for e in TimelineEntry.query.all()}
+            self.assertEqual(readers, {self.u1_id, self.u2_id})
+
+            self.login(c, self.u1_id)
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("Hello followers", html)
+
+    def test_follow_backfills_and_unfollow_prunes(self):
+        """Do follows copy old messages in, and unfollows take them out?"""
+        m = Message(text="Old news", user_id=self.u2_id)
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+
+            c.post(f"/users/follow/{self.u2_id}")
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=self.u1_id).count(), 1)
+
+            c.post(f"/users/stop-following/{self.u2_id}")
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=self.u1_id).count(), 0)
+
+    def test_celebrity_messages_are_read_not_fanned_out(self):
+        """Are celebrities merged into the feed at read time instead?"""
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+            c.post(f"/users/follow/{self.u2_id}")
+
+            self.login(c, self.u2_id)
+            c.post("/messages/new", data={"text": "Hello fans"})
+
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=self.u1_id).count(), 0)
+
+            self.login(c, self.u1_id)
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("Hello fans", html)
@@ -0,0 +1,193 @@
+"""Trending messages tests."""
+
+# run these tests like:
+# python -m unittest test_trending.py
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy.exc import OperationalError
+
+from db_setup import connect_db, db
+from users.models import User
+from messages.models import Message, TrendingMessage
+from messages.trending import CountMinSketch, TopK, Trending, trending
+from likes.models import Like
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import CURR_USER_KEY, app
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class TopKTestCase(TestCase):
+    """Test the in-process counting structures."""
+
+    def test_count_min_sketch(self):
+        """Are estimates exact when keys don't collide?"""
+        sketch = CountMinSketch(width=1024, depth=4)
+        for _ in range(3):
+            sketch.add('a')
+        self.assertEqual(sketch.add('b', 2), 2)
+        self.assertEqual(sketch.estimate('a'), 3)
+        self.assertEqual(sketch.estimate('c'), 0)
+
+    def test_top_k_keeps_highest(self):
+        """Are low scorers evicted once the top k is full?"""
+        top = TopK(2)
+        top.offer('a', 1)
+        top.offer('b', 2)
+        top.offer('c', 1)
+        self.assertEqual(dict(top.items()), {'a': 1, 'b': 2})
+
+        top.offer('c', 3)
+        self.assertEqual(dict(top.items()), {'b': 2, 'c': 3})
+
+        top.offer('b', 4)
+        top.offer('a', 2)
+        self.assertEqual(dict(top.items()), {'b': 4, 'c': 3})
+
+
+class TrendingTestCase(TestCase):
+    """Test the trending messages page."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+        db.session.rollback()
+        TrendingMessage.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        trending.init_app(app)
+
+        users = [User(email=f"test{i}@test.com",
+                      username=f"testuser{i}",
+                      password="HASHED_PASSWORD")
+                 for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.user_ids = [u.id for u in users]
+
+        messages = [Message(text=f"Message {i}", user_id=users[0].id)
+                    for i in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+        self.message_ids = [m.id for m in messages]
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        TrendingMessage.query.delete()
+        Like.query.delete()
+        db.session.commit()
+
+    def like(self, user_id, message_id):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.put(f"/api/v1/messages/{message_id}/like")
+
+    def unlike(self, user_id, message_id):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+            c.delete(f"/api/v1/messages/{message_id}/like")
+
+    def test_trending_order(self):
+        """Do the most liked messages come first, once snapshotted?"""
+        m0, m1, m2 = self.message_ids
+        for user_id in self.user_ids[1:]:
+            self.like(user_id, m1)
+        self.like(self.user_ids[1], m2)
+
+        html = self.client.get("/messages/trending").get_data(as_text=True)
+        self.assertIn("trending yet", html)
+
+        trending.snapshot()
+        html = self.client.get("/messages/trending").get_data(as_text=True)
+        self.assertLess(html.index("Message 1"), html.index("Message 2"))
+        self.assertNotIn("Message 0", html)
+
+    def test_scores_decay(self):
+        """Do likes count for less as they get older?"""
+        m0, m1, m2 = self.message_ids
+        half_life = app.config['TRENDING_HALF_LIFE_HOURS'] * 3600
+
+        # three likes, two half-lives ago, are now worth 3/4...
+        with patch('messages.trending.time', return_value=1e9):
+            for user_id in self.user_ids:
+                self.like(user_id, m1)
+            trending.snapshot()
+
+        # ...so one like now beats them
+        with patch('messages.trending.time',
+                   return_value=1e9 + 2 * half_life):
+            self.like(self.user_ids[1], m2)
+            trending.snapshot()
+
+        top = trending.top(2)
+        self.assertEqual([m.id for m in top], [m2, m1])
+
+    def test_relikes_count_once(self):
+        """Does liking and unliking over and over only count once?"""
+        m0, m1, m2 = self.message_ids
+        for _ in range(5):
+            self.like(self.user_ids[1], m1)
+            self.unlike(self.user_ids[1], m1)
+        self.like(self.user_ids[1], m1)
+        for user_id in self.user_ids[1:]:
+            self.like(user_id, m2)
+
+        trending.snapshot()
+        top = trending.top(2)
+        self.assertEqual([m.id for m in top], [m2, m1])
+
+    def test_failed_snapshot_keeps_counts(self):
+        """Are a failed snapshot's likes written by the next one?"""
+        m0, m1, m2 = self.message_ids
+        self.like(self.user_ids[1], m1)
+
+        error = OperationalError("INSERT", {}, Exception("canceled"))
+        with patch.object(Trending, '_add_scores', side_effect=error):
+            trending.snapshot()
+        self.assertEqual(TrendingMessage.query.count(), 0)
+
+        trending.snapshot()
+        self.assertEqual([m.id for m in trending.top(2)], [m1])
+
+    def test_snapshot_adds_to_existing_scores(self):
+        """Do later snapshots add to a message's score, skipping messages
+        deleted in between?"""
+        m0, m1, m2 = self.message_ids
+        half_life = app.config['TRENDING_HALF_LIFE_HOURS'] * 3600
+
+        with patch('messages.trending.time', return_value=1e9):
+            self.like(self.user_ids[1], m1)
+            trending.snapshot()
+            rank = TrendingMessage.query.get(m1).rank
+
+            self.like(self.user_ids[2], m1)
+            self.like(self.user_ids[1], m0)
+            Message.query.filter_by(id=m0).delete()
+            db.session.commit()
+            trending.snapshot()
+
+        # two likes at once are worth one more halving than one
+        db.session.expire_all()
+        self.assertAlmostEqual(TrendingMessage.query.get(m1).rank, rank + 1)
+        self.assertIsNone(TrendingMessage.query.get(m0))
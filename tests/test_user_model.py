@@ -5,11 +5,13 @@
 
 
 import os
+import time
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 
 from db_setup import connect_db, db
-from users.models import User, Follow
+from users.models import User, Follow, UserGram
+from users.passwords import hasher, PasswordHasher, PasswordHasherBusy
 from messages.models import Message
 
 # BEFORE we import our app, let's set an environmental variable
@@ -131,6 +133,94 @@ class UserModelTestCase(TestCase):
         u.followers.remove(u2)
         self.assertFalse(u.is_followed_by(u2))
 
+    def test_recount(self):
+        """Does recount rebuild the counters from the real rows?"""
+        u = User(email="test@test.com",
+                 username="testuser",
+                 password="HASHED_PASSWORD")
+        u2 = User(email="test2@test2.com",
+                  username="testuser2",
+                  password="HASHED_PASSWORD")
+        u.following.append(u2)
+        u.messages.append(Message(text="Test Message"))
+        db.session.add_all([u, u2])
+        db.session.commit()
+        self.assertEqual(u.following_count, 0)
+
+        User.recount()
+        db.session.commit()
+
+        self.assertEqual(u.messages_count, 1)
+        self.assertEqual(u.following_count, 1)
+        self.assertEqual(u.followers_count, 0)
+        self.assertEqual(u2.followers_count, 1)
+        self.assertEqual(u2.likes_count, 0)
+
+    def test_is_following_saved_users(self):
+        """Do the follow checks work without loading the collections?"""
+        u = User(email="test@test.com",
+                 username="testuser",
+                 password="HASHED_PASSWORD")
+        u2 = User(email="test2@test2.com",
+                  username="testuser2",
+                  password="HASHED_PASSWORD")
+        u3 = User(email="test3@test3.com",
+                  username="testuser3",
+                  password="HASHED_PASSWORD")
+        u.following.append(u2)
+        db.session.add_all([u, u2, u3])
+        db.session.commit()
+
+        # commit expires the collections, so these go to the follows table
+        self.assertTrue(u.is_following(u2))
+        self.assertFalse(u.is_following(u3))
+        self.assertTrue(u2.is_followed_by(u))
+        self.assertFalse(u.is_followed_by(u2))
+
+        self.assertEqual(User.following_status(u, [u2.id, u3.id]),
+                         {u2.id: True, u3.id: False})
+        self.assertEqual(User.following_status(None, [u2.id]),
+                         {u2.id: False})
+
+    def test_search(self):
+        """Does the search index find and rank users?"""
+        warbler = User(email="test@test.com",
+                       username="warbler",
+                       password="HASHED_PASSWORD")
+        birder = User(email="test2@test2.com",
+                      username="birder",
+                      password="HASHED_PASSWORD",
+                      bio="I love a good warbler")
+        other = User(email="test3@test3.com",
+                     username="other",
+                     password="HASHED_PASSWORD",
+                     location="Warsaw")
+        db.session.add_all([warbler, birder, other])
+        db.session.commit()
+
+        # username matches outrank bio matches
+        self.assertEqual(UserGram.search("ARBL", limit=10),
+                         [warbler, birder])
+        self.assertEqual(UserGram.search("arsa", limit=10), [other])
+        self.assertEqual(UserGram.search("arbl", limit=1, offset=1),
+                         [birder])
+        self.assertEqual(UserGram.search("bi", limit=10), [birder])
+        self.assertEqual(UserGram.search("nobody", limit=10), [])
+
+        # wildcards in the term are taken literally: this has every gram of
+        # "ab_cd" and matches it as a LIKE pattern, but doesn't contain it
+        other.bio = "abxcd ab_c _cd"
+        db.session.commit()
+        self.assertEqual(UserGram.search("ab_cd", limit=10), [])
+        other.bio = "ab_cd"
+        db.session.commit()
+        self.assertEqual(UserGram.search("ab_cd", limit=10), [other])
+
+        # the index follows profile edits
+        birder.update_from_serial({"bio": "Birds!"})
+        db.session.commit()
+        self.assertEqual(UserGram.search("arbl", limit=10), [warbler])
+
     def test_update_from_serial(self):
         """ test to make sure update from serial works as expected"""
         u = User(email="test@test.com",
@@ -258,3 +348,32 @@ class UserModelTestCase(TestCase):
         authenticated_u = User.authenticate(
             username=u_info['username'], password=u.password)
         self.assertFalse(authenticated_u)
+
+    def test_user_authenticate_rehashes_old_cost(self):
+        """Does logging in upgrade a hash made at an old bcrypt cost?"""
+
+        u = User.signup(email="test@test.com",
+                        username="testuser",
+                        password="PASSWORD",
+                        image_url=None)
+        db.session.commit()
+
+        old_rounds = app.config['BCRYPT_LOG_ROUNDS']
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        try:
+            self.assertTrue(hasher.needs_rehash(u.password))
+
+            old_hash = u.password
+            self.assertEqual(User.authenticate("testuser", "PASSWORD"), u)
+            self.assertNotEqual(u.password, old_hash)
+            self.assertFalse(hasher.needs_rehash(u.password))
+            self.assertEqual(User.authenticate("testuser", "PASSWORD"), u)
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = old_rounds
+
+    def test_hasher_gives_up_on_slow_hashes(self):
+        """Does a hash stuck in the queue past the timeout get turned away?"""
+
+        slow = PasswordHasher(workers=1, max_queued=0, timeout=0.01)
+        with self.assertRaises(PasswordHasherBusy):
+            slow._run(time.sleep, 0.2)
@@ -5,11 +5,16 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 import os
+from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
 
 from db_setup import connect_db, db
 from users.models import User
 from messages.models import Message
+from likes.models import Like
+from users.current import snapshots
+import fragments
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -22,6 +27,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import CURR_USER_KEY, app
+from users.auth_routes import init_login_throttle
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
@@ -92,6 +98,9 @@ class UserViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        # ids get reused between tests, so drop anything cached under them
+        snapshots.clear()
+        fragments.cache.clear()
 
         self.client = app.test_client()
 
@@ -277,6 +286,161 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 302)
 
 
+    def test_follow_counters(self):
+        """Do follows and unfollows keep the profile counters in step?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/users/follow/{self.u2_id}')
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+            self.assertEqual(u1.following_count, 1)
+            self.assertEqual(u2.followers_count, 1)
+
+            c.post(f'/users/stop-following/{self.u2_id}')
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+            self.assertEqual(u1.following_count, 0)
+            self.assertEqual(u2.followers_count, 0)
+
+    def test_profile_edit_refreshes_current_user(self):
+        """Does the nav bar pick up a new username straight away?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+            self.assertIn('alt="testuser"', html)
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "password": "testuser"})
+
+            html = c.get(f"/users/{self.u2_id}").get_data(as_text=True)
+            self.assertIn('alt="renamed"', html)
+
+    def test_profile_edit_refreshes_cached_cards(self):
+        """Do user and message cards show a new username straight away?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "Hello"})
+            self.assertIn("@testuser<", c.get("/users").get_data(as_text=True))
+            self.assertIn("@testuser<", c.get("/").get_data(as_text=True))
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "password": "testuser"})
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn("@renamed<", html)
+            self.assertNotIn("@testuser<", html)
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("@renamed<", html)
+            self.assertNotIn("@testuser<", html)
+
+    def test_search_users(self):
+        """Does the search box find users by part of their username?"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get("/users?q=user2").get_data(as_text=True)
+            self.assertIn("@testuser2", html)
+            self.assertNotIn("@testuser<", html)
+
+            html = c.get("/users?q=zzz").get_data(as_text=True)
+            self.assertIn("Sorry, no users found", html)
+
+    def test_search_users_short_terms(self):
+        """Do one- and two-letter searches match anywhere in a username,
+        bio or location?"""
+        user = User.query.get(self.u2_id)
+        user.bio = "Birds!"
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get("/users?q=2").get_data(as_text=True)
+            self.assertIn("@testuser2", html)
+            self.assertNotIn("@testuser<", html)
+
+            html = c.get("/users?q=r2").get_data(as_text=True)
+            self.assertIn("@testuser2", html)
+
+            html = c.get("/users?q=ir").get_data(as_text=True)
+            self.assertIn("@testuser2", html)
+            self.assertNotIn("@testuser<", html)
+
+            html = c.get("/users?q=_").get_data(as_text=True)
+            self.assertIn("Sorry, no users found", html)
+
+    def test_user_profile_pagination(self):
+        """Does the profile page hand out cursors to older messages?"""
+        app.config['MESSAGES_PER_PAGE'] = 2
+        for i in range(3):
+            db.session.add(Message(text=f"Message {i}", user_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.u1_id}")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Message 2", html)
+            self.assertIn("Message 1", html)
+            self.assertNotIn("Message 0", html)
+            self.assertIn("Older warbles", html)
+
+            cursor = html.split("before=")[1].split('"')[0]
+            resp = c.get(f"/users/{self.u1_id}?before={cursor}")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Message 0", html)
+            self.assertNotIn("Message 1", html)
+            self.assertNotIn("Older warbles", html)
+
+            resp = c.get(f"/users/{self.u1_id}?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+        app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_show_likes_pages_by_when_liked(self):
+        """Does the likes page list the most recently liked first?"""
+        app.config['MESSAGES_PER_PAGE'] = 1
+        older = Message(text="Older message", user_id=self.u2_id,
+                        timestamp=datetime(2020, 1, 1))
+        newer = Message(text="Newer message", user_id=self.u2_id,
+                        timestamp=datetime(2020, 1, 2))
+        db.session.add_all([older, newer])
+        db.session.commit()
+        db.session.add(Like(user_id=self.u1_id, message_id=newer.id,
+                            timestamp=datetime(2021, 1, 1)))
+        db.session.add(Like(user_id=self.u1_id, message_id=older.id,
+                            timestamp=datetime(2021, 1, 2)))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f"/users/{self.u1_id}/likes").get_data(as_text=True)
+            self.assertIn("Older message", html)
+            self.assertNotIn("Newer message", html)
+
+            cursor = html.split("before=")[1].split('"')[0]
+            html = (c.get(f"/users/{self.u1_id}/likes?before={cursor}")
+                    .get_data(as_text=True))
+            self.assertIn("Newer message", html)
+            self.assertNotIn("Older message", html)
+
+        app.config['MESSAGES_PER_PAGE'] = 100
+
+
 class UserAuthenticationViewsTestCase(TestCase):
     """Test views for routes having to do with User authentication ."""
 
@@ -324,6 +488,27 @@ class UserAuthenticationViewsTestCase(TestCase):
             with c.session_transaction() as sess:
                 self.assertEqual(sess[CURR_USER_KEY], self.u1_info["id"])
 
+    def test_user_login_throttled(self):
+        """are repeated login attempts for a username refused"""
+        limit = app.config['LOGIN_ATTEMPTS_PER_USERNAME']
+        bad_login = {"username": "testuser", "password": "wrong-password"}
+        # start from fresh counters, and leave fresh ones for other tests
+        init_login_throttle(app)
+        try:
+            # a fixed clock, so the attempts can't straddle two windows
+            with self.client as c, patch('throttling.time', return_value=0):
+                for _ in range(limit):
+                    resp = c.post('/login', data=bad_login)
+                    self.assertEqual(resp.status_code, 200)
+
+                resp = c.post('/login', data=self.u1_info)
+                self.assertEqual(resp.status_code, 429)
+                self.assertIn(b"Too many login attempts", resp.data)
+                with c.session_transaction() as sess:
+                    self.assertIsNone(sess.get(CURR_USER_KEY))
+        finally:
+            init_login_throttle(app)
+
     def test_user_logout(self):
         """can a user logout"""
         with self.client as c:
@@ -0,0 +1,96 @@
+"""Rate limiting for Warbler.
+
+`SlidingWindowLimiter` keeps its counters in a backend with two methods,
+`get(key)` and `incr(key, ttl)`. That's the shape of Redis' GET and
+INCR + EXPIRE, so a shared store can be dropped in to make limits hold
+across workers. `MemoryBackend` is the in-process default: it's bounded,
+evicting the least recently used counters, so a flood of distinct keys
+can't grow it without limit.
+"""
+
+from threading import Lock
+from time import time
+
+from caching import TTLCache
+
+
+class MemoryBackend:
+    """Counters kept in this process, in an LRU/TTL cache."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._caches = {}
+
+    def _cache(self, ttl):
+        # a TTLCache has a single ttl, so keep one per ttl in use
+        cache = self._caches.get(ttl)
+        if cache is None:
+            cache = self._caches[ttl] = TTLCache(self.maxsize, ttl)
+        return cache
+
+    def get(self, key):
+        """Get the counter for `key` (0 if it's not set)."""
+
+        with self._lock:
+            for cache in self._caches.values():
+                count = cache.get(key)
+                if count is not None:
+                    return count
+            return 0
+
+    def incr(self, key, ttl):
+        """Add one to the counter for `key`, which expires after `ttl`
+        seconds; returns the new count."""
+
+        with self._lock:
+            cache = self._cache(ttl)
+            count = cache.get(key, 0) + 1
+            cache.set(key, count)
+            return count
+
+    def clear(self):
+        """Drop every counter."""
+
+        with self._lock:
+            self._caches.clear()
+
+
+class SlidingWindowLimiter:
+    """Allows `limit` hits per key in any `window` seconds.
+
+    This is the sliding window counter approximation: hits are counted in
+    fixed windows, and the previous window's count is weighted by how
+    much of it still overlaps the sliding window. Each key costs two
+    counters no matter how many hits it gets.
+    """
+
+    def __init__(self, backend, prefix, limit, window):
+        self.backend = backend
+        self.prefix = prefix
+        self.limit = limit
+        self.window = window
+
+    def hit(self, key, now=None):
+        """Record a hit for `key`, if it's under the limit.
+
+        Returns True if the hit is allowed, False if it should be refused.
+        Refused hits aren't counted, so a client that keeps retrying is let
+        back in as soon as its earlier hits slide out of the window.
+        """
+
+        if now is None:
+            now = time()
+
+        current, elapsed = divmod(now, self.window)
+        current = int(current)
+        previous_count = self.backend.get(f"{self.prefix}:{key}:{current - 1}")
+        current_key = f"{self.prefix}:{key}:{current}"
+        current_count = self.backend.get(current_key)
+
+        overlap = 1 - elapsed / self.window
+        if previous_count * overlap + current_count >= self.limit:
+            return False
+
+        self.backend.incr(current_key, ttl=2 * self.window)
+        return True
@@ -0,0 +1,221 @@
+"""Materialized home timelines for Warbler."""
+
+from flask import current_app
+from sqlalchemy import literal
+from sqlalchemy.orm import selectinload
+
+from db_setup import db
+from users.models import User, Follow
+from messages.models import Message
+from pagination import older_than
+
+
+class TimelineEntry(db.Model):
+    """A message fanned out into one user's home timeline.
+
+    Rows are written when a message is posted (fan-out-on-write), so the
+    home feed is a single range scan over (user_id, timestamp) instead of
+    an IN-query over every followed user's messages.
+
+    Authors with more than TIMELINE_FANOUT_LIMIT followers are not fanned
+    out; their messages are merged in when the timeline is read.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_timeline_entries_user_author',
+                 'user_id', 'author_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    def __repr__(self):
+        return f"<TimelineEntry u_id={self.user_id} m_id={self.message_id}>"
+
+    @staticmethod
+    def is_celebrity(user_id):
+        """Does `user_id` have too many followers to fan out to?"""
+
+        followers = (db.session
+                     .query(User.followers_count)
+                     .filter(User.id == user_id)
+                     .scalar())
+        return (followers or 0) >= current_app.config['TIMELINE_FANOUT_LIMIT']
+
+    @staticmethod
+    def celebrity_ids(user_id):
+        """Ids of the celebrity accounts `user_id` follows."""
+
+        limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+        rows = (db.session
+                .query(Follow.user_being_followed_id)
+                .join(User, User.id == Follow.user_being_followed_id)
+                .filter(Follow.user_following_id == user_id,
+                        User.followers_count >= limit)
+                .all())
+        return [row[0] for row in rows]
+
+    @classmethod
+    def fan_out(cls, message):
+        """Push a newly posted `message` into its readers' timelines.
+
+        The author always gets the message. Followers only get it if the
+        author is not a celebrity.
+        """
+
+        db.session.execute(cls.__table__.insert().values(
+            user_id=message.user_id,
+            message_id=message.id,
+            author_id=message.user_id,
+            timestamp=message.timestamp))
+
+        if cls.is_celebrity(message.user_id):
+            return
+
+        followers = (db.session
+                     .query(Follow.user_following_id,
+                            literal(message.id),
+                            literal(message.user_id),
+                            literal(message.timestamp, db.DateTime))
+                     .filter(Follow.user_being_followed_id == message.user_id))
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            followers))
+
+    @classmethod
+    def backfill(cls, user_id, followed_id):
+        """Copy `followed_id`'s recent messages into `user_id`'s timeline."""
+
+        if cls.is_celebrity(followed_id):
+            return
+
+        recent = (db.session
+                  .query(literal(user_id),
+                         Message.id,
+                         Message.user_id,
+                         Message.timestamp)
+                  .filter(Message.user_id == followed_id)
+                  .order_by(Message.timestamp.desc())
+                  .limit(current_app.config['TIMELINE_BACKFILL']))
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            recent))
+
+    @classmethod
+    def prune(cls, user_id, followed_id):
+        """Remove `followed_id`'s messages from `user_id`'s timeline."""
+
+        (cls.query
+         .filter(cls.user_id == user_id, cls.author_id == followed_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def for_user(cls, user_id, limit, position=None, query=None):
+        """Up to `limit` messages from `user_id`'s home timeline.
+
+        Messages are newest first, starting after the (timestamp, id)
+        `position` if one is given.
+
+        `query` chooses what's loaded for each message (by default,
+        Messages with their users). It must select from messages, and its
+        rows must have `timestamp` and `id` attributes.
+        """
+
+        if query is None:
+            query = Message.query.options(selectinload(Message.user))
+
+        timeline = (query
+                    .join(cls, cls.message_id == Message.id)
+                    .filter(cls.user_id == user_id))
+        if position:
+            timeline = timeline.filter(
+                older_than(cls.timestamp, cls.message_id, position))
+        messages = (timeline
+                    .order_by(cls.timestamp.desc(), cls.message_id.desc())
+                    .limit(limit)
+                    .all())
+
+        # fan-out-on-read for the celebrities this user follows
+        celebrity_ids = cls.celebrity_ids(user_id)
+        if celebrity_ids:
+            celebrities = query.filter(Message.user_id.in_(celebrity_ids))
+            if position:
+                celebrities = celebrities.filter(
+                    older_than(Message.timestamp, Message.id, position))
+            messages.extend(celebrities
+                            .order_by(Message.timestamp.desc(),
+                                      Message.id.desc())
+                            .limit(limit)
+                            .all())
+            messages = sorted(set(messages),
+                              key=lambda msg: (msg.timestamp, msg.id),
+                              reverse=True)[:limit]
+
+        return messages
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild every timeline from the follows and messages tables."""
+
+        cls.query.delete(synchronize_session=False)
+
+        own = db.session.query(Message.user_id,
+                               Message.id,
+                               Message.user_id.label('author_id'),
+                               Message.timestamp)
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            own))
+
+        limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+        celebrities = (db.session
+                       .query(User.id)
+                       .filter(User.followers_count >= limit))
+
+        # like a backfill, followers get each author's most recent messages
+        ranked = (db.session
+                  .query(Message.id,
+                         Message.user_id,
+                         Message.timestamp,
+                         db.func.row_number().over(
+                             partition_by=Message.user_id,
+                             order_by=Message.timestamp.desc()
+                         ).label('recency'))
+                  .filter(~Message.user_id.in_(celebrities))
+                  .subquery())
+        followed = (db.session
+                    .query(Follow.user_following_id,
+                           ranked.c.id,
+                           ranked.c.user_id,
+                           ranked.c.timestamp)
+                    .join(ranked,
+                          ranked.c.user_id == Follow.user_being_followed_id)
+                    .filter(ranked.c.recency
+                            <= current_app.config['TIMELINE_BACKFILL']))
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            followed))
@@ -1,5 +1,6 @@
 from flask import Blueprint, render_template, redirect, flash, g, request, session
 from db_setup import db
+from throttling import MemoryBackend, SlidingWindowLimiter
 
 from users.models import User
 from users.forms import UserAddForm, LoginForm
@@ -10,6 +11,9 @@ CURR_USER_KEY = "curr_user"
 
 auth_views = Blueprint('authentication_routes', __name__)
 
+# Set up by init_login_throttle(): one limiter keyed by username, one by IP.
+login_limiters = []
+
 
 ##############################################################################
 # User signup/login/logout
@@ -20,6 +24,36 @@ def do_login(user):
     session[CURR_USER_KEY] = user.id
 
 
+def init_login_throttle(app, backend=None):
+    """Set up login attempt limits from the app's config.
+
+    `backend` holds the counters; by default they're kept in this
+    process, so each worker enforces the limits on its own.
+    """
+
+    if backend is None:
+        backend = MemoryBackend(app.config['LOGIN_THROTTLE_KEYS'])
+    window = app.config['LOGIN_ATTEMPT_WINDOW']
+
+    login_limiters[:] = [
+        SlidingWindowLimiter(backend, 'login-username',
+                             app.config['LOGIN_ATTEMPTS_PER_USERNAME'],
+                             window),
+        SlidingWindowLimiter(backend, 'login-ip',
+                             app.config['LOGIN_ATTEMPTS_PER_IP'],
+                             window),
+    ]
+
+
+def login_allowed(username):
+    """Count a login attempt; False if this username or IP has had too
+    many lately."""
+
+    keys = (username.lower(), request.remote_addr)
+    return all(limiter.hit(key)
+               for limiter, key in zip(login_limiters, keys))
+
+
 def do_logout():
     """Logout user."""
 
@@ -70,10 +104,17 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
+        if not login_allowed(form.username.data):
+            flash("Too many login attempts. Please wait a few minutes "
+                  "and try again.", 'danger')
+            return render_template('users/login.html', form=form), 429
+
         user = User.authenticate(form.username.data,
                                  form.password.data)
 
         if user:
+            # authenticate may have upgraded the password hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -0,0 +1,86 @@
+"""The logged-in user, as seen by every request."""
+
+from caching import TTLCache
+from db_setup import db
+from users.models import User, Follow
+
+# How long a snapshot may be served before it's re-read from the db, and
+# how many users' snapshots each worker keeps around.
+CACHE_TTL = 30
+CACHE_SIZE = 10000
+
+SNAPSHOT_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.messages_count,
+    User.following_count,
+    User.followers_count,
+    User.likes_count,
+    User.version,
+)
+
+snapshots = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+
+
+class CurrentUser:
+    """A slim, cacheable snapshot of the logged-in user.
+
+    Has the columns the nav bar, home page and message cards need. Routes
+    that change the user call `load()` to get the full `User` row.
+    """
+
+    def __init__(self, snapshot):
+        self.__dict__.update(snapshot)
+        self._snapshot = snapshot
+        self._user = None
+        self._following = {}
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    def load(self):
+        """The full `User` for this snapshot (loaded at most once)."""
+
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        return self._user
+
+    def state(self):
+        """Everything in the snapshot, e.g. for building an ETag."""
+
+        return tuple(sorted(self._snapshot.items()))
+
+    def is_following(self, other_user):
+        """Is this user following `other_user`? (asked once per request)"""
+
+        if other_user.id not in self._following:
+            self._following[other_user.id] = Follow.exists(
+                follower_id=self.id, followed_id=other_user.id)
+        return self._following[other_user.id]
+
+
+def get_current_user(user_id):
+    """The `CurrentUser` for `user_id`, or None if there's no such user."""
+
+    snapshot = snapshots.get(user_id)
+
+    if snapshot is None:
+        row = (db.session
+               .query(*SNAPSHOT_COLUMNS)
+               .filter(User.id == user_id)
+               .first())
+        if row is None:
+            return None
+
+        snapshot = dict(zip(row.keys(), row))
+        snapshots.set(user_id, snapshot)
+
+    return CurrentUser(snapshot)
+
+
+def forget_user(user_id):
+    """Drop the cached snapshot of `user_id` after it has changed."""
+
+    snapshots.delete(user_id)
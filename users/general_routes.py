@@ -1,16 +1,59 @@
-from flask import Blueprint, render_template, redirect, flash, g, request, url_for
+from flask import Blueprint, render_template, redirect, flash, g, request, url_for, current_app
 from db_setup import db
-from users.models import User
+from users.models import (User, Follow, UserGram, FollowSuggestion,
+                          StaleSuggestions)
 from users.forms import UserEditForm
 from users.auth_routes import do_logout
+from users.current import forget_user
 
 from messages.models import Message
+from likes.models import Like
+from pagination import current_position, paginate
+from conditional import not_modified
+from timelines.models import TimelineEntry
 
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 
 user_views = Blueprint('user_routes', __name__)
 
 
+##############################################################################
+# Following and unfollowing, shared with the JSON API:
+
+
+def follow(follow_id):
+    """Have the logged-in user follow `follow_id`. Returns whether they
+    weren't already."""
+
+    added = Follow.add(g.user.id, follow_id)
+    if added:
+        TimelineEntry.backfill(g.user.id, follow_id)
+        StaleSuggestions.mark(g.user.id, follow_id)
+        User.bump(g.user.id, following_count=1)
+        User.bump(follow_id, followers_count=1)
+        db.session.commit()
+        forget_user(g.user.id)
+        forget_user(follow_id)
+    return added
+
+
+def unfollow(follow_id):
+    """Have the logged-in user stop following `follow_id`. Returns whether
+    they were."""
+
+    removed = Follow.remove(g.user.id, follow_id)
+    if removed:
+        TimelineEntry.prune(g.user.id, follow_id)
+        StaleSuggestions.mark(g.user.id, follow_id)
+        User.bump(g.user.id, following_count=-1)
+        User.bump(follow_id, followers_count=-1)
+        db.session.commit()
+        forget_user(g.user.id)
+        forget_user(follow_id)
+    return removed
+
+
 ##############################################################################
 # General user routes:
 
@@ -18,19 +61,50 @@ user_views = Blueprint('user_routes', __name__)
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio or
+    location (ranked, a 'page' at a time). Without one, lists users in
+    sign-up order, a page at a time starting 'after' a user id.
     """
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
     search = request.args.get('q')
+    per_page = current_app.config['USERS_PER_PAGE']
+    next_page = None
 
     if not search:
-        users = User.query.all()
+        after = request.args.get('after', 0, type=int)
+        users = (User
+                 .query
+                 .filter(User.id > after)
+                 .order_by(User.id)
+                 .limit(per_page + 1)
+                 .all())
+        if len(users) > per_page:
+            users = users[:per_page]
+            next_page = {'after': users[-1].id}
     else:
-        users = User.query.filter(User.username.ilike(f"%{search}%")).all()
-
-    return render_template('users/index.html', users=users)
+        page = max(request.args.get('page', 1, type=int), 1)
+        users = UserGram.search(search,
+                                limit=per_page + 1,
+                                offset=(page - 1) * per_page)
+        if len(users) > per_page:
+            users = users[:per_page]
+            next_page = {'q': search, 'page': page + 1}
+
+    # suggestions go above the first page of the directory
+    suggestions = []
+    if not search and not request.args.get('after'):
+        suggestions = FollowSuggestion.for_user(
+            g.user.id, current_app.config['FOLLOW_SUGGESTIONS_SHOWN'])
+
+    return render_template(
+        'users/index.html',
+        users=users,
+        suggestions=suggestions,
+        next_page=next_page,
+        following_status=User.following_status(
+            g.user, [u.id for u in users + suggestions]))
 
 
 @user_views.route('/users/<int:user_id>')
@@ -41,13 +115,24 @@ def users_show(user_id):
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    messages, next_cursor = paginate(
+        Message.query.filter(Message.user_id == user_id),
+        Message.timestamp, Message.id, current_position())
+    liked_ids = Like.liked_ids(g.user, messages)
+    following = g.user and g.user.is_following(user)
+
+    if not_modified(user.id, user.version, user.messages_count,
+                    user.following_count, user.followers_count,
+                    user.likes_count,
+                    [(msg.id, msg.timestamp) for msg in messages],
+                    next_cursor, liked_ids, following):
+        return "", 304
+
+    return render_template('users/show.html',
+                           user=user,
+                           messages=messages,
+                           liked_ids=liked_ids,
+                           next_cursor=next_cursor)
 
 
 @user_views.route('/users/<int:user_id>/following')
@@ -59,7 +144,13 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    users = user.following
+    return render_template(
+        'users/following.html',
+        user=user,
+        users=users,
+        following_status=User.following_status(g.user,
+                                               [u.id for u in users]))
 
 
 @user_views.route('/users/<int:user_id>/followers')
@@ -71,7 +162,13 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    users = user.followers
+    return render_template(
+        'users/followers.html',
+        user=user,
+        users=users,
+        following_status=User.following_status(g.user,
+                                               [u.id for u in users]))
 
 
 @user_views.route('/users/<int:user_id>/likes')
@@ -84,7 +181,22 @@ def show_likes(user_id):
 
     user = User.query.get_or_404(user_id)
 
-    return render_template('users/liked_messages.html', user=user)
+    # most recently liked first, a page of the likes index at a time
+    rows, next_cursor = paginate(
+        (db.session
+         .query(Message, Like.timestamp.label('liked_at'))
+         .select_from(Like)
+         .join(Message, Message.id == Like.message_id)
+         .options(selectinload(Message.user))
+         .filter(Like.user_id == user_id)),
+        Like.timestamp, Like.message_id, current_position(),
+        key=lambda row: (row.liked_at, row.Message.id))
+    messages = [row.Message for row in rows]
+    return render_template('users/liked_messages.html',
+                           user=user,
+                           messages=messages,
+                           liked_ids=Like.liked_ids(g.user, messages),
+                           next_cursor=next_cursor)
 
 
 @user_views.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -97,9 +209,8 @@ def add_follow(follow_id):
     if g.user.id == follow_id:
         flash("You Can't follow yourself Bud.", "warning")
         return redirect(f"/users/{g.user.id}")
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    User.query.get_or_404(follow_id)
+    follow(follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -112,9 +223,7 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    unfollow(follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -126,17 +235,19 @@ def profile():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    form = UserEditForm(obj=g.user)
+    user = g.user.load()
+    form = UserEditForm(obj=user)
     # form is valid?
     if form.validate_on_submit():
         # form has valid Pword?
-        if User.authenticate(username=g.user.username, password=form.password.data):
+        if User.authenticate(username=user.username, password=form.password.data):
 
-            g.user.update_from_serial(request.form)
-            db.session.add(g.user)
+            user.update_from_serial(request.form)
+            db.session.add(user)
             try:
                 db.session.commit()
-                return redirect(url_for("user_routes.users_show", user_id=g.user.id))
+                forget_user(user.id)
+                return redirect(url_for("user_routes.users_show", user_id=user.id))
 
             except IntegrityError:
                 flash("Username or email already taken", 'danger')
@@ -156,7 +267,39 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # the cascading deletes don't touch the other users' counters
+    User.bump((db.session
+               .query(Follow.user_being_followed_id)
+               .filter(Follow.user_following_id == g.user.id)),
+              followers_count=-1)
+    User.bump((db.session
+               .query(Follow.user_following_id)
+               .filter(Follow.user_being_followed_id == g.user.id)),
+              following_count=-1)
+    # (someone may have liked several of this user's messages)
+    likes_lost = (db.session
+                  .query(db.func.count())
+                  .select_from(Like)
+                  .join(Message, Message.id == Like.message_id)
+                  .filter(Like.user_id == User.id,
+                          Message.user_id == g.user.id)
+                  .correlate(User)
+                  .as_scalar())
+    (User
+     .query
+     .filter(User.id.in_(db.session
+                         .query(Like.user_id)
+                         .join(Message, Message.id == Like.message_id)
+                         .filter(Message.user_id == g.user.id)))
+     .update({User.likes_count: User.likes_count - likes_lost},
+             synchronize_session=False))
+    Message.bump((db.session
+                  .query(Like.message_id)
+                  .filter(Like.user_id == g.user.id)),
+                 likes_count=-1)
+
+    db.session.delete(g.user.load())
     db.session.commit()
+    forget_user(g.user.id)
 
     return redirect("/signup")
@@ -1,8 +1,8 @@
 
-from flask_bcrypt import Bcrypt
-from db_setup import db
+from sqlalchemy import inspect
+from db_setup import db, insert_ignore
 from likes.models import Like
-bcrypt = Bcrypt()
+from users.passwords import hasher
 
 
 class Follow(db.Model):
@@ -10,6 +10,13 @@ class Follow(db.Model):
 
     __tablename__ = 'follows'
 
+    __table_args__ = (
+        # the primary key answers "who follows X?"; this answers "who does
+        # X follow?"
+        db.Index('ix_follows_following',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -22,6 +29,38 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? (a single PK probe)"""
+
+        return db.session.query(
+            cls.query
+            .filter(cls.user_being_followed_id == followed_id,
+                    cls.user_following_id == follower_id)
+            .exists()
+        ).scalar()
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Have `follower_id` follow `followed_id`.
+
+        Returns False (and changes nothing) if they already did.
+        """
+
+        return insert_ignore(cls,
+                             user_following_id=follower_id,
+                             user_being_followed_id=followed_id)
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Have `follower_id` stop following `followed_id`; False if they
+        weren't."""
+
+        return bool(cls.query
+                    .filter(cls.user_following_id == follower_id,
+                            cls.user_being_followed_id == followed_id)
+                    .delete(synchronize_session=False))
+
 
 class User(db.Model):
     """User in the system."""
@@ -68,6 +107,46 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts for the profile stats, kept up to date by the
+    # routes that change them (see `bump`) and repaired by `recount`.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever what other people see of the user (name, pictures,
+    # bio) changes; cached cards (see fragments) are keyed on it.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -92,19 +171,45 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def _has_loaded(self, collection):
+        """Is `collection` already in memory (or not yet in the db)?"""
+
+        return self.id is None or collection not in inspect(self).unloaded
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        if self._has_loaded('followers'):
+            return other_user in self.followers
+        return Follow.exists(follower_id=other_user.id, followed_id=self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
+
+        if self._has_loaded('following'):
+            return other_user in self.following
+        return Follow.exists(follower_id=self.id, followed_id=other_user.id)
+
+    @staticmethod
+    def following_status(viewer, user_ids):
+        """Map each of `user_ids` to whether `viewer` follows them.
+
+        Resolves the follow buttons for a whole page of user cards in one
+        query.
+        """
+
+        status = dict.fromkeys(user_ids, False)
+        if not viewer or not status:
+            return status
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        rows = (db.session
+                .query(Follow.user_being_followed_id)
+                .filter(Follow.user_following_id == viewer.id,
+                        Follow.user_being_followed_id.in_(list(status)))
+                .all())
+        for row in rows:
+            status[row[0]] = True
+        return status
 
     def update_from_serial(self, d):
         username = d.get('username')
@@ -135,6 +240,45 @@ class User(db.Model):
         if location:
             self.location = location
 
+        self.version = (self.version or 1) + 1
+
+    @classmethod
+    def bump(cls, ids, **deltas):
+        """Adjust counter columns in place, e.g. bump(5, likes_count=1).
+
+        `ids` is a single user id or a query of user ids. The UPDATE is
+        done in SQL, so concurrent requests can't lose each other's counts.
+        """
+
+        if isinstance(ids, int):
+            users = cls.query.filter(cls.id == ids)
+        else:
+            users = cls.query.filter(cls.id.in_(ids))
+
+        users.update({getattr(cls, column): getattr(cls, column) + delta
+                      for column, delta in deltas.items()},
+                     synchronize_session=False)
+
+    @classmethod
+    def recount(cls):
+        """Recompute every user's counter columns from scratch."""
+
+        from messages.models import Message
+
+        def count_of(user_id_column):
+            return (db.session
+                    .query(db.func.count())
+                    .filter(user_id_column == cls.id)
+                    .correlate(cls)
+                    .as_scalar())
+
+        cls.query.update({
+            cls.messages_count: count_of(Message.user_id),
+            cls.following_count: count_of(Follow.user_following_id),
+            cls.followers_count: count_of(Follow.user_being_followed_id),
+            cls.likes_count: count_of(Like.user_id),
+        }, synchronize_session=False)
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -142,7 +286,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -163,13 +307,263 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the password was hashed at an old cost, it's rehashed at the
+        current one (the caller commits the change).
+
+        Raises PasswordHasherBusy if too many logins are in flight.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
+
+
+class UserGram(db.Model):
+    """One entry in the user search index.
+
+    Each searchable field of a user is broken into lowercase trigrams, so
+    a substring search for "arbl" only has to look at users having both
+    "arb" and "rbl" instead of scanning the users table with ILIKE.
+
+    Terms of one or two letters have no trigrams, so those searches still
+    scan the users table with ILIKE (limited to the page asked for).
+    """
+
+    __tablename__ = 'user_grams'
+
+    # Fields that are searched, and how much a match in each one counts
+    # towards a user's rank.
+    FIELDS = {
+        'username': 3,
+        'location': 2,
+        'bio': 1,
+    }
+
+    gram = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    field = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    @staticmethod
+    def grams(text):
+        """The set of trigrams in `text`."""
+
+        text = (text or '').lower()
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @classmethod
+    def rows_for(cls, user_id, username, bio, location):
+        """The index rows for one user."""
+
+        rows = []
+        values = {'username': username, 'bio': bio, 'location': location}
+        for field, value in values.items():
+            rows.extend({'gram': gram, 'field': field, 'user_id': user_id}
+                        for gram in cls.grams(value))
+        return rows
+
+    @classmethod
+    def index(cls, connection, user):
+        """Replace `user`'s entries in the index."""
+
+        connection.execute(
+            cls.__table__.delete().where(cls.user_id == user.id))
+        rows = cls.rows_for(user.id, user.username, user.bio, user.location)
+        if rows:
+            connection.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        """Rebuild the whole index from the users table."""
+
+        cls.query.delete(synchronize_session=False)
+
+        users = (db.session
+                 .query(User.id, User.username, User.bio, User.location)
+                 .order_by(User.id))
+        rows = []
+        for user in users.yield_per(batch_size):
+            rows.extend(cls.rows_for(*user))
+            if len(rows) >= batch_size:
+                db.session.execute(cls.__table__.insert(), rows)
+                rows = []
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def search(cls, term, limit, offset=0):
+        """Users matching `term`, best match first.
+
+        A user matches if `term` appears in their username, bio or
+        location (case-insensitively). Users rank higher for matching in
+        more important fields, then for having a shorter username.
+        """
+
+        term = term.lower()
+        # (taking any % and _ in the term literally)
+        pattern = '%{}%'.format(term
+                                .replace('\\', '\\\\')
+                                .replace('%', '\\%')
+                                .replace('_', '\\_'))
+        grams = cls.grams(term)
+        if not grams:
+            return cls._scan(pattern, limit, offset)
+
+        # (user, field) pairs whose field has every gram of the term
+        candidates = (db.session
+                      .query(cls.user_id, cls.field)
+                      .filter(cls.gram.in_(grams))
+                      .group_by(cls.user_id, cls.field)
+                      .having(db.func.count() == len(grams))
+                      .subquery())
+
+        # the grams can all be there without the term itself being there,
+        # so check the (few) candidates for the real substring
+        weight = db.case(
+            [(candidates.c.field == field, weight)
+             for field, weight in cls.FIELDS.items()])
+        found = db.or_(*[
+            db.and_(candidates.c.field == field,
+                    getattr(User, field).ilike(pattern, escape='\\'))
+            for field in cls.FIELDS])
+
+        return (User
+                .query
+                .join(candidates, candidates.c.user_id == User.id)
+                .filter(found)
+                .group_by(User.id)
+                .order_by(db.func.sum(weight).desc(),
+                          db.func.length(User.username),
+                          User.id)
+                .limit(limit)
+                .offset(offset)
+                .all())
+
+    @classmethod
+    def _scan(cls, pattern, limit, offset):
+        """`search` without the index: users with a field ILIKE `pattern`,
+        ranked the same way."""
+
+        weight = sum(
+            db.case([(getattr(User, field).ilike(pattern, escape='\\'),
+                      weight)],
+                    else_=0)
+            for field, weight in cls.FIELDS.items())
+
+        return (User
+                .query
+                .filter(weight > 0)
+                .order_by(weight.desc(),
+                          db.func.length(User.username),
+                          User.id)
+                .limit(limit)
+                .offset(offset)
+                .all())
+
+
+class FollowSuggestion(db.Model):
+    """Someone `user_id` might want to follow, with how strongly.
+
+    Computed from the follows graph by the batch job in users.suggestions.
+    """
+
+    __tablename__ = 'follow_suggestions'
+
+    __table_args__ = (
+        # a user's best suggestions
+        db.Index('ix_follow_suggestions_user_score', 'user_id', 'score'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    suggested_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    @classmethod
+    def for_user(cls, user_id, limit):
+        """`user_id`'s top `limit` suggested Users, best first.
+
+        Skips anyone they've followed since the suggestions were computed.
+        """
+
+        followed = (Follow
+                    .query
+                    .filter(Follow.user_following_id == user_id,
+                            Follow.user_being_followed_id == cls.suggested_id)
+                    .exists())
+        return (User
+                .query
+                .join(cls, cls.suggested_id == User.id)
+                .filter(cls.user_id == user_id, ~followed)
+                .order_by(cls.score.desc(), User.id)
+                .limit(limit)
+                .all())
+
+
+class StaleSuggestions(db.Model):
+    """Users whose follows (or followers) changed since the suggestions
+    job last ran; it recomputes the suggestions that depend on them."""
+
+    __tablename__ = 'stale_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    @classmethod
+    def mark(cls, *user_ids):
+        """Flag `user_ids` for the next run."""
+
+        for user_id in user_ids:
+            insert_ignore(cls, user_id=user_id)
+
+
+@db.event.listens_for(User, 'after_insert')
+def index_new_user(mapper, connection, user):
+    """Add new users to the search index."""
+
+    UserGram.index(connection, user)
+
+
+@db.event.listens_for(User, 'after_update')
+def reindex_user(mapper, connection, user):
+    """Keep the search index in step with profile edits."""
+
+    state = inspect(user)
+    if any(state.attrs[field].history.has_changes()
+           for field in UserGram.FIELDS):
+        UserGram.index(connection, user)
@@ -0,0 +1,98 @@
+"""Password hashing for Warbler, in a bounded worker pool.
+
+bcrypt is deliberately slow (~250ms at the default cost). Hashing runs in
+a small thread pool (bcrypt releases the GIL while it works) so a burst of
+logins can only ever use PASSWORD_HASH_WORKERS cores. Once
+PASSWORD_HASH_QUEUE hashes are waiting, new ones are turned away with
+`PasswordHasherBusy` instead of piling up behind them, as are any that
+wait longer than PASSWORD_HASH_TIMEOUT seconds.
+
+That only means something with threaded workers (the Procfile runs
+gunicorn's gthread workers): a sync worker handles one request at a
+time, so it never has more than one hash in flight, and a login ties up
+the whole worker while it hashes.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from threading import BoundedSemaphore
+
+from flask import current_app, has_app_context
+from flask_bcrypt import Bcrypt
+
+bcrypt = Bcrypt()
+
+
+class PasswordHasherBusy(Exception):
+    """Too many password hashes are already queued; try again later."""
+
+
+class PasswordHasher:
+    """Runs bcrypt hashes and checks in a bounded pool of threads."""
+
+    def __init__(self, workers=4, max_queued=16, timeout=10):
+        self.app = None
+        self.configure(workers, max_queued, timeout)
+
+    def init_app(self, app):
+        """Set up bcrypt and the pool from the app's config."""
+
+        self.app = app
+        bcrypt.init_app(app)
+        self.configure(app.config.get('PASSWORD_HASH_WORKERS', 4),
+                       app.config.get('PASSWORD_HASH_QUEUE', 16),
+                       app.config.get('PASSWORD_HASH_TIMEOUT', 10))
+
+    def configure(self, workers, max_queued, timeout):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='bcrypt')
+        # running + waiting jobs
+        self._slots = BoundedSemaphore(workers + max_queued)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # (it keeps its slot until it does finish)
+            raise PasswordHasherBusy()
+
+    @property
+    def rounds(self):
+        """The configured bcrypt cost."""
+
+        app = current_app if has_app_context() else self.app
+        return app.config['BCRYPT_LOG_ROUNDS']
+
+    def hash(self, password):
+        """Hash `password` at the configured cost."""
+
+        return self._run(bcrypt.generate_password_hash,
+                         password, self.rounds).decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the `hashed` one?"""
+
+        return self._run(bcrypt.check_password_hash, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a different cost than the configured one?"""
+
+        # bcrypt hashes look like $2b$12$<salt+hash>; 12 is the cost
+        try:
+            cost = int(hashed.split('$')[2])
+        except (IndexError, ValueError):
+            return True
+        return cost != self.rounds
+
+
+hasher = PasswordHasher()
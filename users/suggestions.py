@@ -0,0 +1,174 @@
+"""Batch job: "who to follow" suggestions from the follows graph.
+
+    flask suggest-follows           # just what changed since the last run
+    flask suggest-follows --all     # everyone
+
+The whole follows graph is loaded into a sparse adjacency matrix A
+(A[u, v] = 1 when u follows v). For a block of users at once, with sparse
+matrix products:
+
+- friends of friends: (A @ A)[u, w] is how many people u follows who
+  follow w
+- common followers: (A.T @ A)[u, w] is how many of u's followers also
+  follow w
+
+Each candidate's score is a weighted sum of the two; people u already
+follows (and u) are left out, and the best SUGGESTIONS_PER_USER are
+stored in follow_suggestions. Blocks are scored in a pool of worker
+processes.
+
+Runs are incremental: following/unfollowing marks both users in
+stale_suggestions, and only users whose scores can have changed (those
+users, their followers and the people they follow) are recomputed.
+
+Either way, each block's suggestions are replaced as it's saved, so users
+keep seeing their old ones until their new ones are in.
+
+Needs numpy and scipy, which the web app itself doesn't.
+"""
+
+from multiprocessing import Pool
+
+import numpy as np
+from scipy import sparse
+
+from db_setup import db
+from users.models import User, Follow, FollowSuggestion, StaleSuggestions
+
+SUGGESTIONS_PER_USER = 20
+COMMON_FOLLOWER_WEIGHT = 0.5
+
+# users scored per matrix product
+BLOCK_SIZE = 2000
+# edges read from the database at a time
+FETCH_SIZE = 100000
+
+# set in each worker process by _init_worker
+_follows = None
+_followers = None
+
+
+def load_graph():
+    """The follows graph as a CSR matrix: row u has a 1 in column v when
+    u follows v. Users are rows/columns by id."""
+
+    size = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+
+    edges = (db.session
+             .query(Follow.user_following_id, Follow.user_being_followed_id)
+             .yield_per(FETCH_SIZE))
+    chunks = []
+    chunk = []
+    for edge in edges:
+        chunk.append(edge)
+        if len(chunk) == FETCH_SIZE:
+            chunks.append(np.array(chunk, dtype=np.int32))
+            chunk = []
+    if chunk:
+        chunks.append(np.array(chunk, dtype=np.int32))
+
+    edges = (np.concatenate(chunks) if chunks
+             else np.empty((0, 2), dtype=np.int32))
+    weights = np.ones(len(edges), dtype=np.float32)
+    return sparse.csr_matrix((weights, (edges[:, 0], edges[:, 1])),
+                             shape=(size, size))
+
+
+def affected_users(follows, stale_ids):
+    """Ids of the users whose suggestions depend on `stale_ids`' follows:
+    them, their followers and the people they follow."""
+
+    stale = np.zeros(follows.shape[0], dtype=np.float32)
+    stale[stale_ids] = 1
+    near = follows @ stale + follows.T @ stale + stale
+    return np.flatnonzero(near)
+
+
+def _init_worker(follows):
+    global _follows, _followers
+    _follows = follows
+    _followers = follows.T.tocsr()
+
+
+def score_block(user_ids):
+    """Top suggestions for each of `user_ids`, as (user, suggested, score)
+    rows."""
+
+    user_ids = np.asarray(user_ids)
+    follows = _follows[user_ids]
+
+    scores = (follows @ _follows
+              + COMMON_FOLLOWER_WEIGHT * (_followers[user_ids] @ _follows))
+    # not people they already follow
+    scores = (scores - scores.multiply(follows)).tocsr()
+
+    rows = []
+    for i, user_id in enumerate(user_ids):
+        start, end = scores.indptr[i], scores.indptr[i + 1]
+        candidates = scores.indices[start:end]
+        values = scores.data[start:end]
+
+        keep = (candidates != user_id) & (values > 0)
+        candidates, values = candidates[keep], values[keep]
+        if len(values) > SUGGESTIONS_PER_USER:
+            best = np.argpartition(-values, SUGGESTIONS_PER_USER)
+            best = best[:SUGGESTIONS_PER_USER]
+            candidates, values = candidates[best], values[best]
+
+        rows.extend((int(user_id), int(suggested), float(score))
+                    for suggested, score in zip(candidates, values))
+    return user_ids.tolist(), rows
+
+
+def save(user_ids, rows):
+    """Replace the suggestions for `user_ids` with `rows`."""
+
+    (FollowSuggestion
+     .query
+     .filter(FollowSuggestion.user_id.in_(user_ids))
+     .delete(synchronize_session=False))
+    if rows:
+        db.session.execute(
+            FollowSuggestion.__table__.insert(),
+            [{'user_id': user_id, 'suggested_id': suggested, 'score': score}
+             for user_id, suggested, score in rows])
+    db.session.commit()
+
+
+def suggest_follows(everyone=False, workers=None):
+    """Recompute follow suggestions; returns how many users were done."""
+
+    stale_ids = [id for id, in db.session.query(StaleSuggestions.user_id)]
+    if not everyone and not stale_ids:
+        return 0
+
+    follows = load_graph()
+    if everyone:
+        user_ids = np.flatnonzero(follows.getnnz(axis=1)
+                                  + follows.getnnz(axis=0))
+    else:
+        user_ids = affected_users(follows, stale_ids)
+
+    blocks = [user_ids[i:i + BLOCK_SIZE]
+              for i in range(0, len(user_ids), BLOCK_SIZE)]
+    with Pool(workers, initializer=_init_worker,
+              initargs=(follows,)) as pool:
+        for block_ids, rows in pool.imap_unordered(score_block, blocks):
+            save(block_ids, rows)
+
+    if everyone:
+        # users who aren't in the graph any more have nothing to suggest
+        in_graph = db.union(
+            db.select([Follow.user_following_id]),
+            db.select([Follow.user_being_followed_id]))
+        (FollowSuggestion
+         .query
+         .filter(~FollowSuggestion.user_id.in_(in_graph))
+         .delete(synchronize_session=False))
+
+    (StaleSuggestions
+     .query
+     .filter(StaleSuggestions.user_id.in_(stale_ids))
+     .delete(synchronize_session=False))
+    db.session.commit()
+    return len(user_ids)